@@ -22,16 +22,44 @@ OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.\
 
 import logging
 import argparse
+import ctypes
+import ctypes.util
+import difflib
+import errno
+import fcntl
+import hashlib
 import os
+import posixpath
+import select
+import shutil
+import stat
 import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
 from re import search
 import subprocess
+from timeit import default_timer
+from multiprocessing.pool import ThreadPool
+from dulwich.client import get_transport_and_path
 from dulwich.config import StackedConfig
-from dulwich.repo import Repo
-from dulwich.objects import Blob, Tree, Commit, parse_timezone, Tag
+from dulwich.diff_tree import tree_changes
+from dulwich.file import FileLocked
+from dulwich.index import index_entry_from_stat
+from dulwich.lru_cache import LRUCache
+from dulwich.object_store import MemoryObjectStore, OverlayObjectStore, \
+    tree_lookup_path
+from dulwich.patch import write_tree_diff
+from dulwich.repo import Repo, MemoryRepo
+from dulwich.objects import Tree, Commit, parse_timezone, Tag, S_ISGITLINK, \
+    hex_to_filename
+from dulwich.pack import OFS_DELTA, REF_DELTA
+from dulwich.refs import SYMREF
 from datetime import datetime
 import json
-from time import time
+from tempfile import mkdtemp, mkstemp
+from time import time, sleep, mktime
 
 exit_codes = {
     1: 'Operation failed.  Exiting.',
@@ -45,6 +73,7 @@ exit_codes = {
     10: 'Please specify number of deploy tags to emit with -c.  Exiting',
     11: 'Could not find any deploys.  Exiting',
     12: 'dulwich call failed. Exiting',
+    13: 'Failed to push deploy refs to remote(s). Exiting.',
     20: 'Cannot find top level directory for the git repository. Exiting.',
     21: 'Missing system configuration item "hook-dir". Exiting.',
     22: 'Missing repo configuration item "tag-prefix". '
@@ -54,7 +83,16 @@ exit_codes = {
     31: 'Failed to write tag on sync. Exiting.',
     32: 'Failed to write the .deploy file. Exiting.',
     40: 'Failed to run sync script. Exiting.',
+    41: 'Invalid environment name. Exiting.',
+    42: 'Unknown deploy unit, see "git config deploy.units". Exiting.',
+    43: 'Invalid deploy config value, see "git config --get-regexp '
+        'deploy". Exiting.',
     50: 'Failed to read the .deploy file. Exiting.',
+    51: 'Working tree has drifted from the deployed tag.',
+    60: 'Artifact not found in cache.',
+    61: 'Path not found in the tree of the tag. Exiting.',
+    62: 'Unknown commit. Exiting.',
+    63: 'Failed to store the artifact in the cache. Exiting.',
 }
 
 
@@ -83,6 +121,98 @@ log = logging.getLogger(__name__)
 log.addHandler(NullHandler())
 
 
+class Profiler(object):
+    """ Deterministic profiler accumulating time per call stack
+
+        Results are written in the collapsed stack format read by
+        flamegraph.pl, along with a summary of the hottest functions.
+        Time under subprocess and dulwich frames is reported as its own
+        category so process waits and object store work stand apart.
+    """
+
+    CATEGORIES = ('subprocess', 'dulwich')
+
+    def __init__(self):
+        self.stacks = {}                    # collapsed stack -> self time
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self._callback)
+        sys.setprofile(self._callback)
+
+    def stop(self):
+        sys.setprofile(None)
+        threading.setprofile(None)
+
+    def _frame_name(self, frame, event, arg):
+        if event.startswith('c_'):
+            return '{0}.{1}'.format(getattr(arg, '__module__', None) or
+                                    '__builtin__', arg.__name__)
+        return '{0}.{1}'.format(frame.f_globals.get('__name__', '?'),
+                                frame.f_code.co_name)
+
+    def _callback(self, frame, event, arg):
+        now = default_timer()
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        if event in ('call', 'c_call'):
+            stack.append([self._frame_name(frame, event, arg), now, 0.0])
+        elif event in ('return', 'c_return', 'c_exception') and stack:
+            name, started, child_time = stack.pop()
+            elapsed = now - started
+            key = ';'.join([entry[0] for entry in stack] + [name])
+            if stack:
+                stack[-1][2] += elapsed
+            with self._lock:
+                self.stacks[key] = self.stacks.get(key, 0.0) + \
+                    elapsed - child_time
+
+    def _category(self, frames):
+        """ Returns the category of the innermost categorised frame """
+        for frame in reversed(frames):
+            for category in self.CATEGORIES:
+                if frame.startswith(category + '.'):
+                    return category
+        return 'other'
+
+    def summary(self, top=20):
+        """ Returns a text summary of the ``top`` functions by self time
+            and the total time per category """
+        functions = {}
+        categories = dict((category, 0.0) for category in
+                          self.CATEGORIES + ('other',))
+        for key, seconds in self.stacks.iteritems():
+            frames = key.split(';')
+            functions[frames[-1]] = functions.get(frames[-1], 0.0) + seconds
+            categories[self._category(frames)] += seconds
+
+        lines = ['{0:>12}  {1}'.format('self (s)', 'function')]
+        for name, seconds in sorted(functions.iteritems(),
+                                    key=lambda item: -item[1])[:top]:
+            lines.append('{0:>12.6f}  {1}'.format(seconds, name))
+        lines.append('')
+        for category, seconds in sorted(categories.iteritems()):
+            lines.append('{0:>12.6f}  [{1}]'.format(seconds, category))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, name):
+        """ Write ``<name>-<timestamp>.collapsed`` and ``.summary`` files
+            under ``directory``, returns their common path prefix """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, '{0}-{1}'.format(
+            name, datetime.now().strftime(Sartoris.DATE_TIME_TAG_FORMAT)))
+        with open(path + '.collapsed', 'w') as f:
+            for key, seconds in sorted(self.stacks.iteritems()):
+                f.write('{0} {1}\n'.format(key, int(seconds * 1e6)))
+        with open(path + '.summary', 'w') as f:
+            f.write(self.summary())
+        return path
+
+
 def parseargs(argv):
     """Parse command line arguments.
 
@@ -95,7 +225,8 @@ def parseargs(argv):
         description="This script performs ",
         epilog="",
         conflict_handler="resolve",
-        usage="sartoris [-q --quiet] [-s --silent] [-v --verbose] [method]"
+        usage="sartoris [-q --quiet] [-s --silent] [-v --verbose] "
+              "[-e --env ENV] [-u --unit UNIT] [method]"
     )
 
     parser.allow_interspersed_args = False
@@ -108,9 +239,32 @@ def parseargs(argv):
 
     # Global options.
     parser.add_argument("method")
+    parser.add_argument("operands", nargs="*", metavar="ARG",
+                        help="arguments to the method, e.g. the deploy "
+                             "tags to compare for changelog")
     parser.add_argument("-c", "--count",
                         default=defaults["quiet"], type=int,
                         help="number of tags to log")
+    parser.add_argument("-e", "--env",
+                        default=None,
+                        help="environment to deploy, each environment has "
+                             "its own lock, tags and deploy state")
+    parser.add_argument("-u", "--unit",
+                        default=None,
+                        help="deploy unit, a subtree of the repo configured "
+                             "in deploy.units with its own lock, tags and "
+                             "deploy state")
+    parser.add_argument("-n", "--dry-run",
+                        default=False, action="store_true",
+                        help="run against an in-memory copy of the repo, "
+                             "nothing is written to disk")
+    parser.add_argument("--json",
+                        default=False, action="store_true",
+                        help="emit output as JSON")
+    parser.add_argument("--profile",
+                        default=False, action="store_true",
+                        help="profile the method, output is written to "
+                             ".git/deploy/profiles/")
     parser.add_argument("-q", "--quiet",
                         default=defaults["quiet"], action="count",
                         help="decrease the logging verbosity")
@@ -125,6 +279,713 @@ def parseargs(argv):
     return args
 
 
+class DiskBackend(object):
+    """ Repository backend for the git checkout at ``top_dir``, the lock
+        and deploy state are kept in files
+
+            **top_dir** - string :: top level directory of the checkout
+            **config** - dict :: deploy config items overriding git config
+    """
+
+    # Whether hooks, pushes and working tree writes are carried out
+    persistent = True
+
+    def __init__(self, top_dir, config=None):
+        self.top_dir = top_dir
+        self.config = config or {}
+        # Read once, the umask can only be read by setting it
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+
+    def get_repo(self):
+        return Repo(self.top_dir)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def write(self, path, data):
+        """ Replace ``path`` atomically so a crash never leaves it half
+            written """
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        # A temp file of its own per write, concurrent writers never share it
+        fd, tmp_path = mkstemp(prefix='.{0}-'.format(os.path.basename(path)),
+                               dir=dir_name or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            # mkstemp creates the file 0600, give it the mode open() would
+            os.chmod(tmp_path, 0666 & ~self.umask)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            os.remove(tmp_path)
+            raise
+
+    def append(self, path, data):
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        with open(path, 'a') as f:
+            f.write(data)
+
+    def remove(self, path):
+        os.remove(path)
+
+
+class MemoryBackend(object):
+    """ Repository backend keeping the repo, lock and deploy state in
+        memory.  Nothing is written to disk, hooks and pushes are skipped.
+
+            **repo** - MemoryRepo :: repo to deploy, an empty one if None
+            **base** - DiskBackend :: optional backend whose files are read
+                       through when not set in memory
+            **config** - dict :: deploy config items overriding git config
+    """
+
+    persistent = False
+
+    def __init__(self, repo=None, base=None, config=None):
+        if repo is None:
+            repo = MemoryRepo()
+            repo.refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+        self.repo = repo
+        self.base = base
+        self.top_dir = base.top_dir if base else ''
+        self.config = config or (base.config if base else {})
+        self._files = {}
+        self._removed = set()
+
+    @classmethod
+    def overlay(cls, base):
+        """ Returns a backend reading objects, refs and files of the disk
+            backend ``base`` while keeping every write in memory """
+        disk_repo = base.get_repo()
+        repo = MemoryRepo()
+        store = MemoryObjectStore()
+        repo.object_store = OverlayObjectStore(
+            [store, disk_repo.object_store], add_store=store)
+        for name, sha in disk_repo.refs.as_dict().iteritems():
+            if name != 'HEAD':
+                repo.refs.add_if_new(name, sha)
+        head = disk_repo.refs.read_ref('HEAD')
+        if head and head.startswith(SYMREF):
+            repo.refs.set_symbolic_ref('HEAD', head[len(SYMREF):])
+        elif head:
+            repo.refs.add_if_new('HEAD', head)
+        return cls(repo, base=base)
+
+    def get_repo(self):
+        return self.repo
+
+    def exists(self, path):
+        if path in self._files:
+            return True
+        if path in self._removed or self.base is None:
+            return False
+        return self.base.exists(path)
+
+    def read(self, path):
+        if path in self._files:
+            return self._files[path]
+        if path in self._removed or self.base is None:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return self.base.read(path)
+
+    def write(self, path, data):
+        self._files[path] = data
+        self._removed.discard(path)
+
+    def append(self, path, data):
+        self.write(path, (self.read(path) if self.exists(path) else '') +
+                   data)
+
+    def remove(self, path):
+        if not self.exists(path):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        self._files.pop(path, None)
+        self._removed.add(path)
+
+
+class ArtifactCache(object):
+    """ Size bounded LRU cache of build outputs on local disk
+
+        Entries are keyed on the sha of the git tree they were built from so
+        an unchanged subtree maps to the same entry across deploys.  Sync
+        hooks run in parallel, entries and the index are only changed under
+        an exclusive lock of the cache directory.
+
+            **directory** - string :: where entries are stored
+            **max_size** - int :: bytes all entries together may take up
+    """
+
+    INDEX_HANDLE = 'index'
+    LOCK_HANDLE = '.lock'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _makedirs(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _lock(self):
+        """ Returns the open lock file once the lock is held """
+        self._makedirs()
+        lock = open(os.path.join(self.directory, self.LOCK_HANDLE), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _unlock(self, lock):
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_HANDLE)) as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp_path = mkstemp(prefix='.index-', dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(index))
+        os.rename(tmp_path, os.path.join(self.directory, self.INDEX_HANDLE))
+
+    def _add_unindexed(self, index):
+        """ Index entries found on disk but not in ``index``, e.g. left by
+            a crashed writer, as least recently used so they go first """
+        for name in os.listdir(self.directory):
+            if name not in index and name != self.INDEX_HANDLE and \
+                    not name.startswith('.'):
+                index[name] = {
+                    'size': self._size(os.path.join(self.directory, name)),
+                    'atime': 0}
+
+    def _size(self, path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        size = 0
+        for dir_name, _, file_names in os.walk(path):
+            for file_name in file_names:
+                size += os.lstat(os.path.join(dir_name, file_name)).st_size
+        return size
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _copy(self, src, dest):
+        if os.path.isdir(src):
+            shutil.copytree(src, dest, symlinks=True)
+        else:
+            shutil.copy2(src, dest)
+
+    def fetch(self, key, dest):
+        """ Copy the entry for ``key`` to ``dest``, replacing it.  Returns
+            boolean flag on whether the entry was cached. """
+        if not os.path.exists(os.path.join(self.directory, key)):
+            return False
+        lock = self._lock()
+        try:
+            index = self._read_index()
+            path = os.path.join(self.directory, key)
+            if key not in index or not os.path.exists(path):
+                return False
+            self._remove(dest)
+            self._copy(path, dest)
+            index[key]['atime'] = time()
+            self._write_index(index)
+        finally:
+            self._unlock(lock)
+        return True
+
+    def store(self, key, src):
+        """ Copy the file or directory ``src`` into the cache under ``key``
+            and evict the least recently used entries over ``max_size`` """
+        self._makedirs()
+
+        # Copy next to the entry first so readers never see a partial one,
+        # only the swap and the index update are done under the lock
+        tmp_dir = mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            self._copy(src, os.path.join(tmp_dir, key))
+            path = os.path.join(self.directory, key)
+            lock = self._lock()
+            try:
+                self._remove(path)
+                os.rename(os.path.join(tmp_dir, key), path)
+
+                index = self._read_index()
+                self._add_unindexed(index)
+                index[key] = {'size': self._size(path), 'atime': time()}
+                total = sum(entry['size'] for entry in index.itervalues())
+                for old_key in sorted(index,
+                                      key=lambda k: index[k]['atime']):
+                    if total <= self.max_size:
+                        break
+                    self._remove(os.path.join(self.directory, old_key))
+                    total -= index.pop(old_key)['size']
+                self._write_index(index)
+            finally:
+                self._unlock(lock)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ObjectSizes(object):
+    """ Reads object sizes from pack and loose object headers
+
+        Objects are never inflated in full, the uncompressed size is taken
+        from the object header and for deltas from the first inflated bytes
+        of the delta.  The packed size of a packed object is the distance to
+        the next object in the pack.
+
+            **object_store** - BaseObjectStore :: store holding the objects
+    """
+
+    def __init__(self, object_store):
+        self.object_store = object_store
+        self._offsets = {}          # sorted object offsets per pack path
+
+    def _read_varint(self, data, i, shift=0):
+        """ Returns the little endian base 128 number at ``data[i]`` and the
+            index past it, the first byte carries ``7 - shift`` bits """
+        byte = ord(data[i])
+        value = byte & (0x7f >> shift)
+        bits = 7 - shift
+        i += 1
+        while byte & 0x80:
+            byte = ord(data[i])
+            value |= (byte & 0x7f) << bits
+            bits += 7
+            i += 1
+        return value, i
+
+    def _inflate_head(self, f, length):
+        """ Returns at least the first ``length`` inflated bytes of the zlib
+            stream read from ``f``, less only if the stream is shorter """
+        decompressor = zlib.decompressobj()
+        head = ''
+        while len(head) < length:
+            chunk = f.read(512)
+            if not chunk:
+                break
+            head += decompressor.decompress(chunk, length - len(head))
+            if decompressor.unused_data:
+                break
+        return head
+
+    def _pack_end_offsets(self, pack):
+        path = pack.data.path
+        if path not in self._offsets:
+            self._offsets[path] = sorted(
+                entry[1] for entry in pack.index.iterentries())
+            self._offsets[path].append(os.path.getsize(path) - 20)
+        return self._offsets[path]
+
+    def _packed_size(self, pack, offset):
+        """ Returns the uncompressed and packed size of the object at
+            ``offset`` in ``pack`` """
+        offsets = self._pack_end_offsets(pack)
+        packed = offsets[bisect_right(offsets, offset)] - offset
+        with open(pack.data.path, 'rb') as f:
+            f.seek(offset)
+            header = f.read(32)
+            type_num = (ord(header[0]) >> 4) & 7
+            size, i = self._read_varint(header, 0, shift=3)
+            if type_num not in (OFS_DELTA, REF_DELTA):
+                return size, packed
+
+            # The delta starts with the base and the result size
+            if type_num == OFS_DELTA:
+                i = self._read_varint(header, i)[1]
+            else:
+                i += 20
+            f.seek(offset + i)
+            delta = self._inflate_head(f, 20)
+            i = self._read_varint(delta, 0)[1]
+            return self._read_varint(delta, i)[0], packed
+
+    def _loose_size(self, path):
+        """ Returns the uncompressed and on disk size of a loose object """
+        with open(path, 'rb') as f:
+            header = self._inflate_head(f, 32)
+        return int(header[header.index(' ') + 1:header.index('\0')]), \
+            os.path.getsize(path)
+
+    def _size(self, store, sha):
+        if isinstance(store, OverlayObjectStore):
+            for base in store.bases:
+                size = self._size(base, sha)
+                if size is not None:
+                    return size
+            return None
+        for pack in getattr(store, 'packs', []):
+            try:
+                return self._packed_size(pack, pack.index.object_index(sha))
+            except KeyError:
+                pass
+        path = getattr(store, 'path', None)
+        if path is not None:
+            try:
+                return self._loose_size(hex_to_filename(path, sha))
+            except (IOError, OSError):
+                return None
+
+        # Objects only held in memory have no packed form
+        if sha in store:
+            size = store[sha].raw_length()
+            return size, size
+        return None
+
+    def get(self, sha):
+        """ Returns the uncompressed and packed size of the object ``sha`` or
+            None if the store does not hold it """
+        return self._size(self.object_store, sha)
+
+
+class TokenBucket(object):
+    """ Token bucket rate limiter shared between threads
+
+        A take may overdraw the bucket, the taker then waits until the debt
+        is paid off at ``rate``, so transfers larger than the bucket are
+        paced rather than refused.
+
+            **rate** - float :: tokens added per second, None for no limit
+            **capacity** - float :: most tokens the bucket holds, one
+                           second worth by default
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self._last = default_timer()
+        self._lock = threading.Lock()
+
+    def take(self, tokens):
+        """ Take ``tokens`` from the bucket, returns the seconds waited """
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = default_timer()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= tokens
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait:
+            sleep(wait)
+        return wait
+
+
+class SyncScheduler(object):
+    """ Runs target transfers in parallel under bandwidth and concurrency
+        budgets, overall and per target group
+
+        Each transfer takes its size from the global and its group's token
+        bucket before it starts.  The number of transfers a group runs at
+        once starts at one and adapts to the observed throughput: the
+        group's throughput is estimated from each finished transfer as its
+        own throughput times the transfers it ran alongside.  The limit
+        grows by one while that holds up and halves when it drops below
+        ``BACKOFF`` of the best seen, e.g. when shared storage saturates,
+        or when a transfer fails.
+
+            **run** - callable :: ``run(target, bandwidth)`` does one
+                      transfer, ``bandwidth`` is its share of the budgets in
+                      bytes per second or None, returns True on success
+            **groups** - dict :: group of each target, "" if not listed
+            **concurrency** - int :: most transfers at once overall
+            **bandwidth** - int :: bytes per second overall, None for none
+            **group_concurrency** - dict :: most transfers at once by group
+            **group_bandwidth** - dict :: bytes per second by group
+    """
+
+    BACKOFF = 0.5
+
+    def __init__(self, run, groups=None, concurrency=1, bandwidth=None,
+                 group_concurrency=None, group_bandwidth=None):
+        self.run = run
+        self.groups = groups or {}
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.group_concurrency = group_concurrency or {}
+        self.group_bandwidth = group_bandwidth or {}
+        self.limits = {}            # adaptive concurrency limit by group
+        self._best = {}             # best throughput seen by group
+        self._active = {}           # transfers running by group
+        self._bucket = TokenBucket(bandwidth)
+        self._group_buckets = {}
+        self._cond = threading.Condition()
+
+    def _max_concurrency(self, group):
+        return min(self.concurrency,
+                   self.group_concurrency.get(group, self.concurrency))
+
+    def _adapt(self, group, throughput, ok):
+        """ Grow or back off the concurrency limit of ``group`` after a
+            transfer finished at ``throughput`` bytes per second """
+        best = self._best.get(group, 0.0)
+        limit = self.limits.get(group, 1)
+        if not ok or throughput < best * self.BACKOFF:
+            self.limits[group] = max(1, limit // 2)
+        else:
+            self.limits[group] = min(limit + 1,
+                                     self._max_concurrency(group))
+        if ok:
+            self._best[group] = max(best, throughput)
+
+    def _next_target(self, pending):
+        """ Returns the first pending target with room in its group """
+        if sum(self._active.values()) >= self.concurrency:
+            return None
+        for target in pending:
+            group = self.groups.get(target, '')
+            if self._active.get(group, 0) < self.limits.get(group, 1):
+                return target
+        return None
+
+    def _share(self, group):
+        """ Returns the bandwidth one more transfer of ``group`` gets """
+        shares = []
+        if self.bandwidth:
+            shares.append(self.bandwidth / max(1, sum(self._active.values())))
+        if self.group_bandwidth.get(group):
+            shares.append(self.group_bandwidth[group] /
+                          max(1, self._active.get(group, 0)))
+        return min(shares) if shares else None
+
+    def _transfer(self, target, group, size, results):
+        with self._cond:
+            running = self._active[group]
+            bucket = self._group_buckets.setdefault(
+                group, TokenBucket(self.group_bandwidth.get(group)))
+        self._bucket.take(size)
+        bucket.take(size)
+        with self._cond:
+            bandwidth = self._share(group)
+
+        start = default_timer()
+        try:
+            ok = bool(self.run(target, bandwidth))
+        except Exception:
+            log.exception('{0}::Transfer to "{1}" failed.'.format(__name__,
+                                                                  target))
+            ok = False
+        elapsed = max(default_timer() - start, 1e-6)
+
+        with self._cond:
+            self._active[group] -= 1
+            self._adapt(group, max(size, 1) * running / elapsed, ok)
+            results[target] = ok
+            self._cond.notify_all()
+
+    def run_all(self, targets, size):
+        """ Transfer ``size`` bytes to each of ``targets``, returns a dict
+            of target to success """
+        pending = list(targets)
+        results = {}
+        with self._cond:
+            while pending or sum(self._active.values()):
+                target = self._next_target(pending)
+                if target is None:
+                    self._cond.wait(1.0)
+                    continue
+                pending.remove(target)
+                group = self.groups.get(target, '')
+                self._active[group] = self._active.get(group, 0) + 1
+                thread = threading.Thread(
+                    target=self._transfer,
+                    args=(target, group, size, results))
+                thread.daemon = True
+                thread.start()
+        return results
+
+
+class DeployStats(object):
+    """ Columnar summary of the deploy history
+
+        Each closed deploy, a start followed by a sync or by another start,
+        is a row of the ``starts`` and ``durations`` columns.  Deploys the
+        journal records an abort for have a duration of ``ABORTED``, starts
+        superseded by another start without either have ``ABANDONED``.
+        ``syncs`` and ``reverts`` hold the times of those events.  Columns
+        are stdlib arrays in time order, a time window is a bisect and
+        aggregates are single passes of builtins over array slices.
+
+        ``state`` holds the open start and the last tags and journal offset
+        read, so updates only look at history added since.
+    """
+
+    COLUMNS = ('starts', 'durations', 'syncs', 'reverts')
+    ABORTED = -1
+    ABANDONED = -2
+
+    # Summaries of another format version are rebuilt from scratch
+    VERSION = 2
+    TYPECODE = 'l'
+
+    def __init__(self):
+        self.columns = dict((name, array(self.TYPECODE))
+                            for name in self.COLUMNS)
+        self.state = {'start_tag': '', 'sync_tag': '', 'open_tag': None,
+                      'open_time': None, 'journal_offset': 0}
+
+    @classmethod
+    def loads(cls, data):
+        """ Returns the summary serialised by ``dumps``, raises ValueError
+            if ``data`` is not one """
+        stats = cls()
+        header, _, body = data.partition('\n')
+        header = json.loads(header)
+        if header.get('version') != cls.VERSION or \
+                header.get('itemsize') != array(cls.TYPECODE).itemsize:
+            raise ValueError('Summary written in another format.')
+        offset = 0
+        for name in cls.COLUMNS:
+            column = stats.columns[name]
+            size = header['columns'][name] * column.itemsize
+            column.fromstring(body[offset:offset + size])
+            offset += size
+        stats.state = header['state']
+        return stats
+
+    def dumps(self):
+        """ Returns a JSON header line followed by the raw columns """
+        header = {'version': self.VERSION, 'state': self.state,
+                  'itemsize': array(self.TYPECODE).itemsize,
+                  'columns': dict((name, len(column)) for name, column in
+                                  self.columns.iteritems())}
+        return json.dumps(header) + '\n' + ''.join(
+            self.columns[name].tostring() for name in self.COLUMNS)
+
+    def _close(self, duration):
+        self.columns['starts'].append(self.state['open_time'])
+        self.columns['durations'].append(duration)
+        self.state['open_tag'] = self.state['open_time'] = None
+
+    def start(self, tag, when):
+        """ A deploy started, one still open was abandoned """
+        if self.state['open_tag'] is not None:
+            self._close(self.ABANDONED)
+        self.state['open_tag'] = tag
+        self.state['open_time'] = when
+
+    def sync(self, when):
+        if self.state['open_tag'] is not None:
+            self._close(when - self.state['open_time'])
+        self.columns['syncs'].append(when)
+
+    def abort(self, tag, when):
+        """ The deploy started by ``tag`` at ``when`` was aborted, it may
+            already be closed as abandoned if a later start was read first
+        """
+        if tag == self.state['open_tag']:
+            self._close(self.ABORTED)
+            return
+        starts = self.columns['starts']
+        durations = self.columns['durations']
+        for i in xrange(bisect_left(starts, when), len(starts)):
+            if starts[i] != when:
+                break
+            if durations[i] == self.ABANDONED:
+                durations[i] = self.ABORTED
+                break
+
+    def revert(self, when):
+        self.columns['reverts'].append(when)
+
+    def summary(self, since=0, until=None):
+        """ Returns deploy frequency, duration and abort figures of the
+            deploys from ``since`` on, times are epoch seconds """
+        until = until or int(time())
+        window = {}
+        for name, column in self.columns.iteritems():
+            key = self.columns['starts'] if name == 'durations' else column
+            window[name] = column[bisect_left(key, since):]
+        durations = window['durations']
+        syncs = window['syncs']
+
+        # Abandoned and aborted deploys sort first, the rest are durations
+        # of synced deploys
+        aborts = durations.count(self.ABORTED)
+        abandoned = durations.count(self.ABANDONED)
+        synced = sorted(durations)[aborts + abandoned:]
+        span = until - (since or (syncs[0] if syncs else until))
+        return {
+            'since': since or None,
+            'deploys': len(syncs),
+            'per_week': len(syncs) * 604800.0 / span if span > 0 else None,
+            'starts': len(durations),
+            'aborts': aborts,
+            'abandoned': abandoned,
+            'abort_rate': float(aborts) / len(durations)
+            if durations else None,
+            'reverts': len(window['reverts']),
+            'duration': {
+                'mean': float(sum(synced)) / len(synced) if synced else None,
+                'median': synced[len(synced) // 2] if synced else None,
+                'p90': synced[min(len(synced) - 1, len(synced) * 9 // 10)]
+                if synced else None,
+                'max': synced[-1] if synced else None,
+            },
+        }
+
+
+class InotifyWatcher(object):
+    """ Waits for changes to entries of a set of directories via inotify
+
+            **dirs** - list :: directories to watch, missing ones are skipped
+
+        Raises OSError where inotify is not available.
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    # IN_DELETE
+    MASK = 0x002 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self, dirs):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_init = libc.inotify_init
+            inotify_add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self._fd = inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        for dir_name in dirs:
+            if os.path.isdir(dir_name):
+                inotify_add_watch(self._fd, dir_name, self.MASK)
+
+    def wait(self, timeout=None):
+        """ Returns True once a change happened, False after ``timeout``
+            seconds without one """
+        ready = select.select([self._fd], [], [], timeout)[0]
+        if ready:
+            # Drain the pending events, callers re-read the state anyway
+            os.read(self._fd, 65536)
+            return True
+        return False
+
+    def close(self):
+        os.close(self._fd)
+
+
 class Sartoris(object):
 
     # Module level attribute for tagging datetime format
@@ -136,94 +997,593 @@ class Sartoris(object):
     # Name of lock file
     LOCK_FILE_HANDLE = 'lock'
 
-    __instance = None                           # class instance
+    # Name of the directory profiler output is written to
+    PROFILE_DIR = DEPLOY_DIR + 'profiles/'
+
+    # Name of the per-target sync checkpoint file
+    SYNC_STATE_HANDLE = 'sync-state'
+
+    # Number of decoded git objects kept in memory by the tag resolver
+    OBJECT_CACHE_SIZE = 1000
+
+    # Name of the changelog cache directory
+    CHANGELOG_CACHE_DIR = 'changelog'
+
+    # Blobs larger than this many bytes get no line stats in the changelog
+    LINE_STATS_MAX_SIZE = 1 << 20
+
+    # Number of threads writing files when the working tree is reset
+    CHECKOUT_THREADS = 8
+
+    # Default number of targets synced at once
+    SYNC_CONCURRENCY = 4
+
+    # Name of the working tree stat cache used by ``verify``
+    STAT_CACHE_HANDLE = 'stat-cache'
+
+    # Number of threads rehashing files in ``verify``
+    HASH_THREADS = 8
+
+    # Seconds between state checks when inotify is not available
+    WATCH_INTERVAL = 1.0
+
+    # Attempts and seconds between them at moving the branch head while
+    # deploys of other environments move it too
+    BRANCH_UPDATE_RETRIES = 20
+    BRANCH_UPDATE_WAIT = 0.05
+
+    # Object sizes read for plan, keyed on the object sha
+    OBJECT_SIZE_CACHE_HANDLE = 'object-sizes'
+
+    # Names of the deploy event journal and the summary ``stats`` reads
+    JOURNAL_HANDLE = 'journal'
+    STATS_HANDLE = 'stats'
+
+    # Name of the build artifact cache directory and its default size bound
+    ARTIFACT_CACHE_DIR = 'artifacts'
+    ARTIFACT_CACHE_SIZE = 1 << 30
+
+    # Environment and unit names are used in paths and tags, they may not
+    # clash with the tag kinds
+    ENV_PATTERN = r'^[A-Za-z0-9_]+$'
+    ENV_RESERVED = ('start', 'sync')
+
+    __instances = {}                    # class instance per env and unit
 
     def __init__(self, *args, **kwargs):
-        """ Initialize class instance """
-        self.__class__.__instance = self
+        """ Initialize class instance
+
+                **env** - string :: optional environment, e.g. "staging"
+                **unit** - string :: optional deploy unit, e.g. "api"
+                **backend** - DiskBackend|MemoryBackend :: optional, by
+                              default the checkout in the CWD
+                **dry_run** - boolean :: keep every change in memory
+        """
+        self.env = kwargs.get('env')
+        self.unit = kwargs.get('unit')
+        self.backend = kwargs.get('backend')
+        self.dry_run = kwargs.get('dry_run', False)
         self._configure()
         self._tag = None                    # Stores tag state
+        self._object_cache = LRUCache(self.OBJECT_CACHE_SIZE)
 
     def __new__(cls, *args, **kwargs):
-        """ This class is Singleton, return only one instance """
-        if not cls.__instance:
-            cls.__instance = super(Sartoris, cls).__new__(cls, *args, **kwargs)
-        return cls.__instance
+        """ This class is Singleton per environment and unit, return only
+            one instance for each.  Instances with their own backend or in
+            dry run mode are never shared. """
+        if kwargs.get('backend') or kwargs.get('dry_run'):
+            return super(Sartoris, cls).__new__(cls)
+        key = kwargs.get('env'), kwargs.get('unit')
+        if key not in cls.__instances:
+            cls.__instances[key] = super(Sartoris, cls).__new__(cls)
+        return cls.__instances[key]
 
     def _configure(self):
         """ Parse configuration from git config """
         sc = StackedConfig(StackedConfig.default_backends())
         self.config = {}
 
-        # Get top level directory of project
-        proc = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        self.config['top_dir'] = proc.communicate()[0]
+        if self.backend is None:
+            # Get top level directory of project
+            proc = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            top_dir = proc.communicate()[0].strip()
+
+            if proc.returncode != 0:
+                exit_code = 20
+                log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+                sys.exit(exit_code)
+
+            self.backend = DiskBackend(top_dir)
+            if self.dry_run:
+                self.backend = MemoryBackend.overlay(self.backend)
+        self.config['top_dir'] = self.backend.top_dir
 
-        if proc.returncode != 0:
-            exit_code = 20
+        if self.env is not None and (not search(self.ENV_PATTERN, self.env) or
+                                     self.env in self.ENV_RESERVED):
+            exit_code = 41
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             sys.exit(exit_code)
 
-        self.config['deploy_file'] = self.config['top_dir'] + '/.git'
-
         try:
-            self.config['hook_dir'] = sc.get('deploy', 'hook-dir')
+            self.config['hook_dir'] = self._get_config_item(sc, 'hook-dir')
         except KeyError:
             exit_code = 21
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             sys.exit(exit_code)
 
         try:
-            self.config['repo_name'] = sc.get('deploy', 'tag-prefix')
+            self.config['repo_name'] = self._get_config_item(sc, 'tag-prefix')
         except KeyError:
             exit_code = 22
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             sys.exit(exit_code)
+
+        # Optional deploy units, "<name>:<path>" subtrees deployed on their own
+        try:
+            self.config['units'] = self._get_config_map(sc, 'units')
+        except ValueError:
+            exit_code = 43
+            log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            sys.exit(exit_code)
+        if self.unit is not None and \
+                (not search(self.ENV_PATTERN, self.unit) or
+                 self.unit in self.ENV_RESERVED or
+                 self.unit not in self.config['units']):
+            exit_code = 42
+            log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            sys.exit(exit_code)
+
+        # Lock, sync state, .deploy file and tags are kept apart per
+        # environment and unit, the .deploy file of a unit lives in its path.
+        # Paths are made from the top dir so every subdirectory of the
+        # checkout shares them.
+        self.config['deploy_root'] = os.path.join(self.config['top_dir'],
+                                                  self.DEPLOY_DIR)
+        deploy_dir = self.config['deploy_root']
+        deploy_file = '.deploy'
+        tag_prefix = self.config['repo_name']
+        self.config['unit_path'] = ''
+        if self.env is not None:
+            deploy_dir += 'env/{0}/'.format(self.env)
+            deploy_file += '.' + self.env
+            tag_prefix += '-' + self.env
+        if self.unit is not None:
+            self.config['unit_path'] = \
+                self.config['units'][self.unit].strip('/')
+            deploy_dir += 'unit/{0}/'.format(self.unit)
+            deploy_file = '{0}/{1}'.format(self.config['unit_path'],
+                                           deploy_file)
+            tag_prefix += '.' + self.unit
+        self.config['deploy_dir'] = deploy_dir
+        self.config['deploy_file'] = '{0}/{1}'.format(self.config['top_dir'],
+                                                      deploy_file)
+        self.config['tag_prefix'] = tag_prefix
         self.config['sync_dir'] = '{0}/sync'.format(self.config['hook_dir'])
 
+        # Identity used for deploy commits and tags
+        try:
+            self.config['author'] = '{0} <{1}>'.format(
+                sc.get('user', 'name'), sc.get('user', 'email'))
+        except KeyError:
+            self.config['author'] = 'author <author@domain.com>'
+
+        # Optional list of remotes, names or urls, deploy refs are pushed to
+        try:
+            self.config['remotes'] = self._get_config_item(
+                sc, 'remotes').split()
+        except KeyError:
+            self.config['remotes'] = []
+
+        try:
+            self._configure_budgets(sc)
+        except ValueError:
+            exit_code = 43
+            log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            sys.exit(exit_code)
+
+    def _configure_budgets(self, sc):
+        """ Parse the artifact cache and sync budgets from git config, raises
+            ValueError on a malformed value """
+        # Optional size bound of the build artifact cache, in bytes
+        try:
+            self.config['artifact_cache_size'] = int(
+                self._get_config_item(sc, 'artifact-cache-size'))
+        except KeyError:
+            self.config['artifact_cache_size'] = self.ARTIFACT_CACHE_SIZE
+
+        # Optional list of sync targets, each is passed to the sync hook
+        try:
+            self.config['targets'] = self._get_config_item(
+                sc, 'targets').split()
+        except KeyError:
+            self.config['targets'] = []
+
+        # Sync budgets, overall and per group of targets sharing a link or
+        # storage backend, groups are "<group>:<target>,<target>"
+        self.config['target_groups'] = {}
+        for group, targets in \
+                self._get_config_map(sc, 'groups').iteritems():
+            for target in targets.split(','):
+                self.config['target_groups'][target] = group
+        try:
+            self.config['concurrency'] = int(
+                self._get_config_item(sc, 'concurrency'))
+        except KeyError:
+            self.config['concurrency'] = self.SYNC_CONCURRENCY
+        try:
+            self.config['bandwidth'] = int(
+                self._get_config_item(sc, 'bandwidth'))
+        except KeyError:
+            self.config['bandwidth'] = None
+        self.config['group_concurrency'] = dict(
+            (group, int(value)) for group, value in
+            self._get_config_map(sc, 'group-concurrency').iteritems())
+        self.config['group_bandwidth'] = dict(
+            (group, int(value)) for group, value in
+            self._get_config_map(sc, 'group-bandwidth').iteritems())
+        if self.config['concurrency'] < 1 or \
+                min(self.config['group_concurrency'].values() or [1]) < 1:
+            raise ValueError('Sync concurrency must be at least 1')
+
+    def _get_config_item(self, sc, name):
+        """ Returns a deploy config item, the backend config takes
+            precedence over git config """
+        if name in self.backend.config:
+            return self.backend.config[name]
+        return sc.get('deploy', name)
+
+    def _get_config_map(self, sc, name):
+        """ Returns a config item of "<key>:<value>" words as a dict, empty
+            if the item is not set, raises ValueError on a word without
+            a ":" """
+        try:
+            items = self._get_config_item(sc, name).split()
+        except KeyError:
+            return {}
+        return dict(item.split(':', 1) for item in items)
+
     def _check_lock(self):
         """ Returns boolean flag on lock file existence """
-        return os.path.exists(self.DEPLOY_DIR + self.LOCK_FILE_HANDLE)
+        return self.backend.exists(self.config['deploy_dir'] +
+                                   self.LOCK_FILE_HANDLE)
 
     def _create_lock(self):
         """ Create a lock file """
-        with open(self.DEPLOY_DIR + self.LOCK_FILE_HANDLE, 'wb'):
-            pass
+        self.backend.write(self.config['deploy_dir'] + self.LOCK_FILE_HANDLE,
+                           '')
+
+    def _remove_lock(self):
+        """ Remove the lock file """
+        if self._check_lock():
+            self.backend.remove(self.config['deploy_dir'] +
+                                self.LOCK_FILE_HANDLE)
+        else:
+            raise SartorisError(message=exit_codes[4], exit_code=4)
+
+    def _read_json(self, path):
+        """ Returns the decoded contents of a JSON file, None if the file
+            is missing or corrupt """
+        try:
+            return json.loads(self.backend.read(path))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_json(self, path, data):
+        """ Write ``data`` to ``path`` as JSON """
+        self.backend.write(path, json.dumps(data))
+
+    def _read_sync_state(self, tag):
+        """ Returns the set of targets checkpointed as synced for ``tag`` """
+        state = self._read_json(self.config['deploy_dir'] +
+                                self.SYNC_STATE_HANDLE)
+        if not state or state.get('tag') != tag:
+            return set()
+        return set(state.get('done', []))
+
+    def _write_sync_state(self, tag, done):
+        """ Checkpoint the targets synced so far for ``tag`` """
+        self._write_json(self.config['deploy_dir'] + self.SYNC_STATE_HANDLE,
+                         {'tag': tag, 'done': sorted(done)})
+
+    def _clear_sync_state(self):
+        """ Drop any sync checkpoint """
+        path = self.config['deploy_dir'] + self.SYNC_STATE_HANDLE
+        if self.backend.exists(path):
+            self.backend.remove(path)
+
+    def _get_deploy_tags(self, kind):
+        """ Returns the sorted deploy tags of this environment of one kind,
+            "start" or "sync".  Timestamps make the sort chronological. """
+        prefix = '{0}-{1}-'.format(self.config['tag_prefix'], kind)
+        return sorted(tag for tag in
+                      self._get_repo().refs.keys(base='refs/tags')
+                      if tag.startswith(prefix))
+
+    def _get_repo(self):
+        """ Returns the dulwich repo of the backend """
+        return self.backend.get_repo()
+
+    def _get_object(self, repo, sha):
+        """ Returns the decoded object for ``sha`` from the LRU cache,
+            reading it from the object store on a miss """
+        obj = self._object_cache.get(sha)
+        if obj is None:
+            obj = repo[sha]
+            self._object_cache[sha] = obj
+        return obj
+
+    def _resolve_tags(self, tags):
+        """ Resolve a list of tags to their commits in one pass over the
+            refs and object store.  Annotated tags are peeled.
+
+                **tags** - list :: tag names, e.g. "<project>-sync-<timestamp>"
+
+            Returns a dict keyed on tag with values of the form:
+
+                {'sha': ..., 'author': ..., 'commit_time': ...,
+                 'message': ...}
+        """
+        repo = self._get_repo()
+        refs = repo.get_refs()
+        resolved = {}
+        for tag in tags:
+            try:
+                obj = self._get_object(repo, refs['refs/tags/' + tag])
+                while isinstance(obj, Tag):
+                    obj = self._get_object(repo, obj.object[1])
+            except KeyError:
+                raise SartorisError(message=exit_codes[7], exit_code=7)
+            resolved[tag] = {
+                'sha': obj.id,
+                'author': obj.author,
+                'commit_time': obj.commit_time,
+                'message': obj.message,
+            }
+        return resolved
+
+    def _get_subtree(self, repo, tree_id, path):
+        """ Returns the sha of the tree at ``path`` below the tree
+            ``tree_id``, ``tree_id`` itself if ``path`` is empty and None if
+            there is no such tree """
+        if not path:
+            return tree_id
+        try:
+            mode, sha = tree_lookup_path(
+                lambda sha: self._get_object(repo, sha), tree_id, path)
+        except KeyError:
+            return None
+        return sha if stat.S_ISDIR(mode) else None
+
+    def _replace_subtree(self, repo, tree_id, path, subtree_id):
+        """ Returns the id of a copy of the tree ``tree_id`` with the entry
+            at ``path`` replaced by the tree ``subtree_id``, or removed if
+            that is None.  Only the trees along ``path`` are rewritten. """
+        name, _, rest = path.partition('/')
+        tree = Tree()
+        child_id = None
+        if tree_id is not None:
+            for entry in self._get_object(repo, tree_id).iteritems():
+                if entry.path != name:
+                    tree.add(entry.path, entry.mode, entry.sha)
+                elif stat.S_ISDIR(entry.mode):
+                    child_id = entry.sha
+        if rest:
+            subtree_id = self._replace_subtree(repo, child_id, rest,
+                                               subtree_id)
+        if subtree_id is not None:
+            tree.add(name, stat.S_IFDIR, subtree_id)
+        repo.object_store.add_object(tree)
+        return tree.id
+
+    def _get_tree_sha(self, tag, path=''):
+        """ Returns the sha of the tree at ``path`` in the commit of ``tag``,
+            the root tree if ``path`` is empty """
+        repo = self._get_repo()
+        tree_id = self._get_subtree(
+            repo, self._get_object(
+                repo, self._get_commit_sha_for_tag(tag)).tree,
+            path.strip('/'))
+        if tree_id is None:
+            raise SartorisError(message=exit_codes[61], exit_code=61)
+        return tree_id
+
+    def _journal(self, event, tag):
+        """ Append a deploy event to the journal """
+        try:
+            self.backend.append(
+                self.config['deploy_dir'] + self.JOURNAL_HANDLE,
+                json.dumps({'event': event, 'tag': tag,
+                            'time': int(time())}) + '\n')
+        except (IOError, OSError):
+            log.warning(__name__ + '::Could not write the deploy journal.')
+
+    def _tag_time(self, tag):
+        """ Returns the epoch time in the name of a deploy tag """
+        return int(mktime(datetime.strptime(
+            '-'.join(tag.rsplit('-', 2)[1:]),
+            self.DATE_TIME_TAG_FORMAT).timetuple()))
+
+    def _get_deploy_stats(self):
+        """ Returns the deploy summary brought up to date with the tags and
+            journal entries added since it was last written """
+        path = self.config['deploy_dir'] + self.STATS_HANDLE
+        try:
+            stats = DeployStats.loads(self.backend.read(path))
+        except (IOError, OSError, ValueError, KeyError):
+            stats = DeployStats()
+        state = stats.state
+
+        # Tag names sort chronologically, tags past the last read are new
+        events = [(self._tag_time(tag), 0, tag)
+                  for tag in self._get_deploy_tags('start')
+                  if tag > state['start_tag']]
+        events.extend((self._tag_time(tag), 1, tag)
+                      for tag in self._get_deploy_tags('sync')
+                      if tag > state['sync_tag'])
+        for when, is_sync, tag in sorted(events):
+            if is_sync:
+                stats.sync(when)
+                state['sync_tag'] = tag
+            else:
+                stats.start(tag, when)
+                state['start_tag'] = tag
+
+        # The journal tells aborts from abandoned starts and has reverts
+        try:
+            journal = self.backend.read(self.config['deploy_dir'] +
+                                        self.JOURNAL_HANDLE)
+        except (IOError, OSError):
+            journal = ''
+        end = journal.rfind('\n') + 1
+        for line in journal[state['journal_offset']:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('event') == 'abort':
+                stats.abort(entry['tag'], self._tag_time(entry['tag']))
+            elif entry.get('event') == 'revert':
+                stats.revert(entry['time'])
+        state['journal_offset'] = end
+
+        try:
+            self.backend.write(path, stats.dumps())
+        except (IOError, OSError):
+            log.warning(__name__ + '::Could not cache deploy stats.')
+        return stats
+
+    def _get_artifact_cache(self):
+        """ Returns the build artifact cache, keyed on tree shas """
+        return ArtifactCache(self.config['deploy_root'] +
+                             self.ARTIFACT_CACHE_DIR,
+                             self.config['artifact_cache_size'])
+
+    def _deploy_snapshot(self):
+        """ Returns the deploy state ``watch`` compares, a tuple of the
+            deploy tags, lock flag and .deploy file contents """
+        tags = set(self._get_deploy_tags('start') +
+                   self._get_deploy_tags('sync'))
+        return tags, self._check_lock(), \
+            self._read_json(self.config['deploy_file'])
+
+    def _snapshot_events(self, old, new, aborted=None):
+        """ Returns the deploy events that lead from snapshot ``old`` to
+            snapshot ``new``.  ``aborted`` is the set of start tags an
+            abort was already emitted for, it is updated in place. """
+        if aborted is None:
+            aborted = set()
+        old_tags, old_lock, old_deploy = old
+        new_tags, new_lock, new_deploy = new
+        start_prefix = '{0}-start-'.format(self.config['tag_prefix'])
+
+        events = []
+        for tag in sorted(new_tags - old_tags):
+            if tag.startswith(start_prefix):
+                events.append({'event': 'start', 'tag': tag})
+            else:
+                events.append({'event': 'sync', 'tag': tag})
+
+        if new_deploy and new_deploy != old_deploy and \
+                new_deploy.get('action') == 'revert':
+            events.append({'event': 'revert', 'tag': new_deploy['tag']})
+
+        # A lock released while the latest start has no later sync is an
+        # abort, tag timestamps sort chronologically.  A revert or resync
+        # after it releases the lock again without a new start.
+        def timestamp(tag):
+            return tag.rsplit('-', 2)[1:]
+
+        if old_lock and not new_lock:
+            start_tags = sorted(t for t in new_tags
+                                if t.startswith(start_prefix))
+            sync_tags = sorted(new_tags.difference(start_tags))
+            if start_tags and start_tags[-1] not in aborted and \
+                    (not sync_tags or timestamp(start_tags[-1]) >
+                     timestamp(sync_tags[-1])):
+                aborted.add(start_tags[-1])
+                events.append({'event': 'abort', 'tag': start_tags[-1]})
+
+        for event in events:
+            event['env'] = self.env
+            event['time'] = int(time())
+        return events
+
+    def watch_events(self, timeout=None):
+        """ Generator of deploy events, dicts of the form:
+
+                {'event': 'start|sync|abort|revert', 'tag': ...,
+                 'env': ..., 'time': ...}
+
+            Changes to refs/tags, packed-refs, the lock and the .deploy file
+            are picked up through inotify, or by polling every
+            ``WATCH_INTERVAL`` seconds where it is unavailable.  With
+            ``timeout`` set the generator ends after that many seconds
+            without an event.
+        """
+        watcher = None
+        if self.backend.persistent:
+            top_dir = self.config['top_dir']
+            deploy_dir = self.config['deploy_dir']
+            if not os.path.exists(deploy_dir):
+                os.makedirs(deploy_dir)
+            try:
+                watcher = InotifyWatcher([
+                    os.path.join(top_dir, '.git', 'refs', 'tags'),
+                    os.path.join(top_dir, '.git'),
+                    os.path.dirname(self.config['deploy_file']),
+                    deploy_dir])
+            except OSError:
+                log.info(__name__ + '::inotify not available, polling.')
+
+        snapshot = self._deploy_snapshot()
+        aborted = set()
+        idle = 0.0
+        try:
+            while True:
+                wait = None if timeout is None else timeout - idle
+                started = default_timer()
+                if watcher is not None:
+                    if not watcher.wait(wait):
+                        return
+                else:
+                    sleep(self.WATCH_INTERVAL if wait is None else
+                          min(self.WATCH_INTERVAL, wait))
+
+                new_snapshot = self._deploy_snapshot()
+                events = self._snapshot_events(snapshot, new_snapshot,
+                                               aborted)
+                snapshot = new_snapshot
+                for event in events:
+                    yield event
+
+                if events:
+                    idle = 0.0
+                else:
+                    idle += default_timer() - started
+                if timeout is not None and idle >= timeout:
+                    return
+        finally:
+            if watcher is not None:
+                watcher.close()
 
     def _get_commit_sha_for_tag(self, tag):
         """ Obtain the commit sha of an associated tag
                 e.g. `git rev-list $TAG | head -n 1` """
-        # @TODO replace with dulwich
-
-        cmd = "git rev-list {0} | head -n 1".format(tag)
-        proc = subprocess.Popen(cmd.split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        tag = proc.communicate()[0].strip()
-
-        if not proc.returncode:
-            return tag
-        else:
+        try:
+            return self._resolve_tags([tag])[tag]['sha']
+        except SartorisError:
             raise SartorisError(message=exit_codes[8], exit_code=8)
 
     def _get_latest_deploy_tag(self):
         """ Returns the latest tag containing 'sync'
             Sets self._tag to tag string
         """
-        proc = subprocess.Popen("git tag".split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        self._tag = None
-        for line_out in proc.communicate()[0].split('\n'):
-            if search(r'sync', line_out):
-                self._tag = line_out
-
-        if proc.returncode:
-            raise SartorisError(message=exit_codes[8], exit_code=8)
-        elif not self._tag:
+        sync_tags = self._get_deploy_tags('sync')
+        if not sync_tags:
             raise SartorisError(message=exit_codes[8], exit_code=8)
+        self._tag = sync_tags[-1]
         return 0
 
     def _dulwich_tag(self, tag, author, message=None):
@@ -236,40 +1596,341 @@ class Sartoris(object):
             message = tag
 
         # Open the repo
-        _repo = Repo(self.config['top_dir'])
-        master_branch = 'master'
-
-        # Build the commit object
-        blob = Blob.from_string("empty")
-        tree = Tree()
-        tree.add(tag, 0100644, blob.id)
-
-        commit = Commit()
-        commit.tree = tree.id
-        commit.author = commit.committer = author
-        commit.commit_time = commit.author_time = int(time())
+        _repo = self._get_repo()
+        object_store = _repo.object_store
         tz = parse_timezone('-0200')[0]
-        commit.commit_timezone = commit.author_timezone = tz
-        commit.encoding = "UTF-8"
-        commit.message = 'Tagging repo for deploy: ' + message
 
-        # Add objects to the repo store instance
-        object_store = _repo.object_store
-        object_store.add_object(blob)
-        object_store.add_object(tree)
-        object_store.add_object(commit)
-        _repo.refs['refs/heads/' + master_branch] = commit.id
+        # Build the commit object on top of the current branch head
+        def build(parent_id):
+            commit = Commit()
+            if parent_id is not None:
+                commit.parents = [parent_id]
+                commit.tree = _repo[parent_id].tree
+            else:
+                tree = Tree()
+                object_store.add_object(tree)
+                commit.tree = tree.id
+            commit.author = commit.committer = author
+            commit.commit_time = commit.author_time = int(time())
+            commit.commit_timezone = commit.author_timezone = tz
+            commit.encoding = "UTF-8"
+            commit.message = 'Tagging repo for deploy: ' + message
+            return commit
+        commit = self._commit_on_branch(_repo, build)
 
         # Build the tag object and tag
-        tag = Tag()
-        tag.tagger = author
-        tag.message = message
-        tag.name = tag
-        tag.object = (Commit, commit.id)
-        tag.tag_time = commit.author_time
-        tag.tag_timezone = tz
-        object_store.add_object(tag)
-        _repo['refs/tags/' + tag] = tag.id
+        tag_obj = Tag()
+        tag_obj.tagger = author
+        tag_obj.message = message
+        tag_obj.name = tag
+        tag_obj.object = (Commit, commit.id)
+        tag_obj.tag_time = commit.author_time
+        tag_obj.tag_timezone = tz
+        object_store.add_object(tag_obj)
+        _repo.refs['refs/tags/' + tag] = tag_obj.id
+
+    def _stat_matches(self, path, entry):
+        """ Returns boolean flag on whether the file at ``path`` still has
+            the mtime and size recorded in its index ``entry`` """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        mtime = entry[1]
+        if isinstance(mtime, tuple):
+            mtime = mtime[0]
+        return int(st.st_mtime) == int(mtime) and st.st_size == entry[7]
+
+    def _checkout_tree(self, repo, tree_id, prefix=''):
+        """ Make the working tree and index below ``prefix`` match the tree
+            ``tree_id``, a None tree removes everything below ``prefix``.
+
+            Only paths whose index entry differs from the target, or whose
+            stat info no longer matches the index, are rewritten.  File
+            writes are spread over a thread pool.
+        """
+        top_dir = self.config['top_dir']
+        index = repo.open_index()
+
+        target = {}
+        if tree_id is not None:
+            for entry in repo.object_store.iter_tree_contents(tree_id):
+                if not S_ISGITLINK(entry.mode):
+                    path = posixpath.join(prefix, entry.path)
+                    target[path] = (entry.mode, entry.sha)
+
+        changed = []
+        for path, (mode, sha) in target.iteritems():
+            full_path = os.path.join(top_dir, path)
+            try:
+                entry = index[path]
+            except KeyError:
+                changed.append(path)
+                continue
+            if entry[8] != sha or entry[4] != mode or \
+                    not self._stat_matches(full_path, entry):
+                changed.append(path)
+        removed = [path for path in index if path not in target and
+                   (not prefix or path.startswith(prefix + '/'))]
+
+        for path in removed:
+            full_path = os.path.join(top_dir, path)
+            if os.path.lexists(full_path):
+                os.unlink(full_path)
+            try:
+                os.removedirs(os.path.dirname(full_path))
+            except OSError:
+                pass
+            del index[path]
+
+        # Blobs are read here as the object store is not shared across
+        # threads, directories are created up front for the same reason
+        writes = []
+        for path in changed:
+            mode, sha = target[path]
+            dir_name = os.path.dirname(os.path.join(top_dir, path))
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            writes.append((path, mode, repo[sha].as_raw_string()))
+
+        def write(item):
+            path, mode, data = item
+            full_path = os.path.join(top_dir, path)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                shutil.rmtree(full_path)
+            elif os.path.lexists(full_path):
+                os.unlink(full_path)
+            if stat.S_ISLNK(mode):
+                os.symlink(data, full_path)
+            else:
+                with open(full_path, 'wb') as f:
+                    f.write(data)
+                os.chmod(full_path, mode & 0777)
+            return os.lstat(full_path)
+
+        if writes:
+            pool = ThreadPool(min(self.CHECKOUT_THREADS, len(writes)))
+            try:
+                stats = pool.map(write, writes)
+            finally:
+                pool.close()
+            for (path, mode, _), st in zip(writes, stats):
+                index[path] = index_entry_from_stat(st, target[path][1], 0,
+                                                    mode=mode)
+        index.write()
+        return changed, removed
+
+    def _hash_file(self, path, st):
+        """ Returns the git blob sha of the file at ``path`` with stat
+            info ``st``, streaming its contents """
+        if stat.S_ISLNK(st.st_mode):
+            data = os.readlink(path)
+            return hashlib.sha1('blob {0}\0{1}'.format(len(data),
+                                                       data)).hexdigest()
+        sha = hashlib.sha1('blob {0}\0'.format(st.st_size))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _find_drift(self, repo, tree_id, prefix=''):
+        """ Compare the working tree below ``prefix`` with the tree
+            ``tree_id``.
+
+            Files whose mtime, size and inode match the persisted stat cache
+            reuse the cached sha, the rest are rehashed in parallel.  Returns
+            a tuple of the modified, missing and added paths, .git and
+            .deploy files are never reported as added.
+        """
+        top_dir = self.config['top_dir']
+        cache_path = self.config['deploy_dir'] + self.STAT_CACHE_HANDLE
+        cache = self._read_json(cache_path) or {}
+
+        target = {}
+        gitlinks = set()
+        hashes = {}
+        suspicious = []
+        missing = []
+        for entry in repo.object_store.iter_tree_contents(tree_id):
+            path = posixpath.join(prefix, entry.path)
+            if S_ISGITLINK(entry.mode):
+                gitlinks.add(path)
+                continue
+            target[path] = entry.mode, entry.sha
+            full_path = os.path.join(top_dir, path)
+            try:
+                st = os.lstat(full_path)
+            except OSError:
+                missing.append(path)
+                continue
+            key = [int(st.st_mtime), st.st_size, st.st_ino]
+            cached = cache.get(path)
+            if cached and cached[:3] == key:
+                hashes[path] = cached[3], st.st_mode
+            else:
+                suspicious.append((path, full_path, st))
+
+        def rehash(item):
+            path, full_path, st = item
+            try:
+                return path, st, self._hash_file(full_path, st)
+            except (IOError, OSError):
+                return path, st, None
+
+        if suspicious:
+            pool = ThreadPool(min(self.HASH_THREADS, len(suspicious)))
+            try:
+                rehashed = pool.map(rehash, suspicious)
+            finally:
+                pool.close()
+        else:
+            rehashed = []
+
+        # Files modified within the last second may change again without
+        # their mtime moving, those are never cached
+        racy_time = int(time()) - 1
+        new_cache = dict((path, cache[path]) for path in hashes)
+        for path, st, sha in rehashed:
+            if sha is None:
+                missing.append(path)
+                continue
+            hashes[path] = sha, st.st_mode
+            if int(st.st_mtime) < racy_time:
+                new_cache[path] = [int(st.st_mtime), st.st_size, st.st_ino,
+                                   sha]
+        try:
+            self._write_json(cache_path, new_cache)
+        except (IOError, OSError):
+            log.warning(__name__ + '::Could not write the stat cache.')
+
+        modified = []
+        for path, (sha, st_mode) in hashes.iteritems():
+            mode, target_sha = target[path]
+            if sha != target_sha or \
+                    stat.S_ISLNK(st_mode) != stat.S_ISLNK(mode) or \
+                    bool(st_mode & 0111) != bool(mode & 0111):
+                modified.append(path)
+
+        # Anything else in the working tree below the prefix was added
+        added = []
+        for dir_path, dir_names, file_names in os.walk(
+                os.path.join(top_dir, prefix)):
+            rel_dir = os.path.relpath(dir_path, top_dir)
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            for name in list(dir_names):
+                path = posixpath.join(rel_dir, name)
+                if name == '.git' or path in gitlinks:
+                    dir_names.remove(name)
+                elif os.path.islink(os.path.join(dir_path, name)):
+                    dir_names.remove(name)
+                    file_names.append(name)
+            for name in file_names:
+                path = posixpath.join(rel_dir, name)
+                if path not in target and not name.startswith('.deploy'):
+                    added.append(path)
+        return sorted(modified), sorted(missing), sorted(added)
+
+    def _commit_tree(self, repo, tree_id, author, message):
+        """ Commit ``tree_id`` on top of the current branch head """
+        def build(parent_id):
+            commit = Commit()
+            commit.parents = [parent_id]
+            commit.tree = tree_id
+            commit.author = commit.committer = author
+            commit.commit_time = commit.author_time = int(time())
+            tz = parse_timezone('-0200')[0]
+            commit.commit_timezone = commit.author_timezone = tz
+            commit.encoding = "UTF-8"
+            commit.message = message
+            return commit
+        return self._commit_on_branch(repo, build).id
+
+    def _commit_on_branch(self, repo, build):
+        """ Add the commit ``build(parent_id)`` returns on top of the
+            current branch head, ``parent_id`` is None on an unborn branch.
+
+            Deploys of other environments move the head too, the ref is
+            only moved if it still points at the parent, otherwise the
+            commit is rebuilt on the new head and the update retried.
+        """
+        branch = self._get_branch_ref(repo)
+        for _ in xrange(self.BRANCH_UPDATE_RETRIES):
+            parent_id = repo.refs[branch] if branch in repo.refs else None
+            commit = build(parent_id)
+            repo.object_store.add_object(commit)
+            try:
+                if parent_id is None:
+                    updated = repo.refs.add_if_new(branch, commit.id)
+                else:
+                    updated = repo.refs.set_if_equals(branch, parent_id,
+                                                      commit.id)
+            except FileLocked:
+                updated = False
+            if updated:
+                return commit
+            sleep(self.BRANCH_UPDATE_WAIT)
+        raise FileLocked(branch, branch + '.lock')
+
+    def _get_branch_ref(self, repo):
+        """ Returns the ref HEAD points at, e.g. "refs/heads/master" """
+        head = repo.refs.read_ref('HEAD')
+        if head and head.startswith(SYMREF):
+            return head[len(SYMREF):]
+        return 'refs/heads/master'
+
+    def _push_remote(self, remote):
+        """ Push the deploy tags missing on ``remote`` and the branch head
+            in a single send-pack.  ``remote`` is a remote name or url. """
+        repo = self._get_repo()
+        try:
+            url = repo.get_config().get(('remote', remote), 'url')
+        except KeyError:
+            url = remote
+        client, path = get_transport_and_path(url)
+
+        local_refs = repo.get_refs()
+        branch = self._get_branch_ref(repo)
+        tag_ref_prefix = 'refs/tags/{0}-'.format(self.config['tag_prefix'])
+
+        def determine_wants(remote_refs):
+            # Unchanged refs are left out of the push by send_pack
+            wants = dict((ref, sha) for ref, sha in remote_refs.iteritems()
+                         if not ref.endswith('^{}'))
+            for ref, sha in local_refs.iteritems():
+                if ref == branch or (ref.startswith(tag_ref_prefix) and
+                                     ref not in remote_refs):
+                    wants[ref] = sha
+            return wants
+
+        client.send_pack(path, determine_wants,
+                         repo.object_store.generate_pack_data)
+
+    def _push_deploy_refs(self):
+        """ Push deploy refs to all configured remotes concurrently, returns
+            False if any push failed """
+        remotes = self.config['remotes']
+        if not remotes:
+            return True
+        if not self.backend.persistent:
+            log.info('{0}::Dry run, not pushing to {1}.'.format(
+                __name__, ', '.join(remotes)))
+            return True
+
+        def push(remote):
+            try:
+                self._push_remote(remote)
+            except Exception as e:
+                log.error('{0}::Push to "{1}" failed: {2}'.format(
+                    __name__, remote, e))
+                return False
+            return True
+
+        pool = ThreadPool(len(remotes))
+        try:
+            results = pool.map(push, remotes)
+        finally:
+            pool.close()
+        return all(results)
 
     def start(self, args):
         """
@@ -288,20 +1949,23 @@ class Sartoris(object):
         self._create_lock()
 
         # Tag the repo at this point
-        repo_name = self.config['repo_name']
+        tag_prefix = self.config['tag_prefix']
         log.debug(__name__ + '::Adding `start` tag for repo.')
 
         timestamp = datetime.now().strftime(self.DATE_TIME_TAG_FORMAT)
 
-        # @TODO use dulwich config to set '_author'
-        _tag = '{0}-start-{1}'.format(repo_name, timestamp)
-        _author = '{0} {1}'.format('author', 'author@domain.com')
+        _tag = '{0}-start-{1}'.format(tag_prefix, timestamp)
+        _author = self.config['author']
 
         try:
             self._dulwich_tag(_tag, _author)
         except Exception:
+            self._remove_lock()
             raise SartorisError(message=exit_codes[12], exit_code=12)
+        self._journal('start', _tag)
 
+        # Mirrors catch up on the next push, the deploy goes on without them
+        self._push_deploy_refs()
         return 0
 
     def abort(self, args):
@@ -309,27 +1973,49 @@ class Sartoris(object):
             * reset state back to start tag
             * remove lock file
         """
+        # Only a deploy in progress can be aborted
+        if not self._check_lock():
+            exit_code = 30
+            log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            return exit_code
 
-        # Get the commit hash of the current tag
-        commit_sha = self._get_commit_sha_for_tag(self._tag)
-
-        # 1. hard reset the index to the desired tree
-        # 2. move the branch pointer back to the previous HEAD
-        # 3. commit revert
-        # @TODO replace with dulwich
-        if subprocess.call("git reset --hard {0}".format(commit_sha).split()):
-            raise SartorisError(message=exit_codes[5], exit_code=5)
-        if subprocess.call("git reset --soft HEAD@{1}".split()):
-            raise SartorisError(message=exit_codes[5], exit_code=5)
-        if subprocess.call("git commit -m 'Revert to {0}'".format(commit_sha).
-                           split()):
+        # Get the commit hash of the start tag of this deploy
+        start_tags = self._get_deploy_tags('start')
+        if not start_tags:
+            raise SartorisError(message=exit_codes[8], exit_code=8)
+        commit_sha = self._get_commit_sha_for_tag(start_tags[-1])
+
+        # 1. reset the working tree and index to the start tree
+        # 2. commit revert on top of the current branch head
+        # A unit only resets its own subtree, the rest of the head is kept
+        repo = self._get_repo()
+        unit_path = self.config['unit_path']
+        _author = self.config['author']
+        try:
+            tree_id = self._get_object(repo, commit_sha).tree
+            if unit_path:
+                unit_tree_id = self._get_subtree(repo, tree_id, unit_path)
+                head_tree_id = self._get_object(
+                    repo, repo.refs[self._get_branch_ref(repo)]).tree
+                tree_id = self._replace_subtree(repo, head_tree_id,
+                                                unit_path, unit_tree_id)
+            else:
+                unit_tree_id = tree_id
+            if self.backend.persistent:
+                changed, removed = self._checkout_tree(repo, unit_tree_id,
+                                                       unit_path)
+            else:
+                changed, removed = [], []
+            self._commit_tree(repo, tree_id, _author,
+                              'Revert to {0}'.format(commit_sha))
+        except (IOError, OSError, KeyError, FileLocked):
             raise SartorisError(message=exit_codes[5], exit_code=5)
+        log.debug('{0}::Reset {1} changed and {2} removed paths.'.format(
+            __name__, len(changed), len(removed)))
 
         # Remove lock file
-        if os.listdir(self.DEPLOY_DIR).__contains__(self.LOCK_FILE_HANDLE):
-            os.remove(self.LOCK_FILE_HANDLE)
-        else:
-            raise SartorisError(message=exit_codes[4])
+        self._remove_lock()
+        self._journal('abort', start_tags[-1])
         return 0
 
     def sync(self, args, no_deps=False, force=False):
@@ -338,73 +2024,183 @@ class Sartoris(object):
             * write a .deploy file with the tag information
             * call a sync hook with the prefix (repo) and tag info
         """
-        #TODO: do git calls in dulwich, rather than shelling out
-        if 'lock' not in os.listdir('.git/deploy'):
+        if not self._check_lock():
             exit_code = 30
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             return exit_code
         repo_name = self.config['repo_name']
-        _tag = "{0}-sync-{1}".format(repo_name,
+        _tag = "{0}-sync-{1}".format(self.config['tag_prefix'],
                                      datetime.now().strftime(
                                          self.DATE_TIME_TAG_FORMAT))
-        proc = subprocess.Popen(['/usr/bin/git tag', '-a', _tag])
-        proc.communicate()
-
-        if proc.returncode != 0:
+        _author = self.config['author']
+        try:
+            self._dulwich_tag(_tag, _author)
+        except Exception:
             exit_code = 31
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             return exit_code
-        # Write .deploy file
+        self._journal('sync', _tag)
+
+        # Write .deploy file, this is the manifest of the deploy
+        targets = self.config['targets']
         try:
-            deploy_file = open(self.config['deploy_file'], 'w')
-            deploy_file.write(json.dumps({'repo': repo_name, 'tag': _tag}))
-            deploy_file.close()
-        except OSError:
+            self._write_json(self.config['deploy_file'],
+                             dict(self._get_manifest(_tag), repo=repo_name,
+                                  env=self.env, targets=targets,
+                                  action='sync', time=int(time())))
+        except (IOError, OSError):
             exit_code = 32
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             return exit_code
-        return self._sync()
-
-    def _sync(self, tag, force):
+        exit_code = self._sync(_tag, force, targets)
+
+        # Mirrors only get the sync tag once the targets run it, a failed
+        # push is caught up by the next one
+        if exit_code == 0:
+            self._push_deploy_refs()
+        return exit_code
+
+    def _get_manifest(self, tag):
+        """ Returns the tag, unit and tree of the deploy of ``tag`` for the
+            .deploy file.  ``changes`` lists the paths changed in the unit
+            since the deploy in the current .deploy file, it is None when
+            that is unknown. """
+        repo = self._get_repo()
+        unit_path = self.config['unit_path']
+        tree_id = self._get_subtree(
+            repo, self._get_object(
+                repo, self._get_commit_sha_for_tag(tag)).tree, unit_path)
+
+        changes = None
+        previous = self._read_json(self.config['deploy_file']) or {}
+        if previous.get('tree') and previous.get('path') == unit_path:
+            try:
+                changes = sorted(set(
+                    change.new.path or change.old.path for change in
+                    tree_changes(repo.object_store, previous['tree'],
+                                 tree_id)))
+            except KeyError:
+                pass
+        return {'tag': tag, 'unit': self.unit, 'path': unit_path,
+                'tree': tree_id, 'changes': changes}
+
+    def _sync_size(self, tag):
+        """ Returns the bytes added or changed in the unit from the sync tag
+            before ``tag`` to ``tag``, 0 if that can not be told """
+        repo = self._get_repo()
+        unit_path = self.config['unit_path']
+        sync_tags = [t for t in self._get_deploy_tags('sync') if t < tag]
+        try:
+            new_tree = self._get_tree_sha(tag, unit_path)
+            old_tree = self._get_tree_sha(sync_tags[-1], unit_path) \
+                if sync_tags else None
+            return self._plan(repo, old_tree, new_tree)['size']
+        except (KeyError, SartorisError):
+            return 0
+
+    def _sync(self, tag, force, targets, resume=False):
+        """
+            * call the sync hook once per target in the manifest, targets
+              are scheduled under the bandwidth and concurrency budgets
+            * checkpoint each target as it completes
+            * when ``resume`` is set skip targets already synced for ``tag``
+            * remove lock file
+        """
         repo_name = self.config['repo_name']
         sync_script = '{0}/{1}.sync'.format(self.config["sync_dir"], repo_name)
-        #TODO: use a pluggable sync system rather than shelling out
-        if os.path.exists(sync_script):
-            proc = subprocess.Popen([sync_script,
-                                     '--repo="{0}"'.format(repo_name),
-                                     '--tag="{0}"'.format(self._tag),
-                                     '--force="{0}"'.format(force)])
-            proc_out = proc.communicate()[0]
-            log.info(proc_out)
 
-            if proc.returncode != 0:
-                exit_code = 40
-                log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
-                return exit_code
-        os.unlink('.git/deploy')
+        if resume:
+            done = self._read_sync_state(tag)
+        else:
+            self._clear_sync_state()
+            done = set()
+
+        if targets:
+            pending = [t for t in targets if t not in done]
+        else:
+            # No configured targets, the hook syncs the whole fleet at once
+            pending = [None]
+        failed = []
+
+        #TODO: use a pluggable sync system rather than shelling out
+        if not self.backend.persistent:
+            log.info('{0}::Dry run, not calling {1} for {2}.'.format(
+                __name__, sync_script, tag))
+            done.update(targets)
+        elif os.path.exists(sync_script):
+            state_lock = threading.Lock()
+
+            def run(target, bandwidth):
+                # No shell runs the hook, so values are passed unquoted, the
+                # quotes on the original three are kept for existing hooks
+                cmd = [sync_script,
+                       '--repo="{0}"'.format(repo_name),
+                       '--tag="{0}"'.format(tag),
+                       '--force="{0}"'.format(force)]
+                if self.env is not None:
+                    cmd.append('--env={0}'.format(self.env))
+                if self.unit is not None:
+                    cmd.append('--unit={0}'.format(self.unit))
+                    cmd.append('--path={0}'.format(
+                        self.config['unit_path']))
+                if target is not None:
+                    cmd.append('--target={0}'.format(target))
+                if bandwidth:
+                    cmd.append('--bandwidth={0}'.format(int(bandwidth)))
+                proc = subprocess.Popen(cmd)
+                proc_out = proc.communicate()[0]
+                log.info(proc_out)
+
+                if proc.returncode != 0:
+                    log.error('{0}::Sync failed for target "{1}".'.format(
+                        __name__, target))
+                    return False
+                if target is not None:
+                    with state_lock:
+                        done.add(target)
+                        self._write_sync_state(tag, done)
+                return True
+
+            # Targets are scheduled under the bandwidth and concurrency
+            # budgets, each transfer is costed at the size of the change
+            scheduler = SyncScheduler(
+                run, groups=self.config['target_groups'],
+                concurrency=self.config['concurrency'],
+                bandwidth=self.config['bandwidth'],
+                group_concurrency=self.config['group_concurrency'],
+                group_bandwidth=self.config['group_bandwidth'])
+            results = scheduler.run_all(pending, self._sync_size(tag))
+            failed = [target for target in pending if not results[target]]
+
+        self._remove_lock()
+
+        # Verify every target in the manifest has been synced
+        if failed or set(targets) - done:
+            exit_code = 40
+            log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            return exit_code
+        self._clear_sync_state()
         return 0
 
     def resync(self, args):
         """
             * write a lock file
-            * call sync hook with the prefix (repo) and tag info
+            * call sync hook with the prefix (repo) and tag info, only for
+              targets not yet synced for that tag
             * remove lock file
         """
         if self._check_lock():
             exit_code = 2
             log.error(__name__ + '::' + exit_codes[exit_code])
             return exit_code
-        self._create_lock()
-        repo_name = self.config['repo_name']
-        try:
-            deploy_file = open(self.config['deploy_file'], 'r')
-            deploy_info = deploy_file.read()
-            deploy_info = json.loads(deploy_info)
-        except OSError:
+        deploy_info = self._read_json(self.config['deploy_file'])
+        if not deploy_info:
             exit_code = 50
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             return exit_code
-        return self._sync(repo_name, deploy_info["tag"])
+        self._create_lock()
+        return self._sync(deploy_info['tag'], False,
+                          deploy_info.get('targets', []), resume=True)
 
     def revert(self, args):
         """
@@ -422,26 +2218,113 @@ class Sartoris(object):
 
         # Get latest "sync" tag - sets self._tag
         self._get_latest_deploy_tag()
+        self._create_lock()
 
         # Write .deploy file
         try:
-            deploy_file = open(self.config['deploy_file'], 'w')
-            deploy_file.write(json.dumps({'repo': repo_name,
-                                          'tag': self._tag}))
-            deploy_file.close()
-        except OSError:
+            self._write_json(self.config['deploy_file'],
+                             dict(self._get_manifest(self._tag),
+                                  repo=repo_name, env=self.env,
+                                  targets=self.config['targets'],
+                                  action='revert', time=int(time())))
+        except (IOError, OSError):
+            self._remove_lock()
             exit_code = 32
             log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
             return exit_code
+        self._journal('revert', self._tag)
 
         # @TODO determine what to pass as arg 2
-        self._sync(self._tag, '')
+        return self._sync(self._tag, '', self.config['targets'])
 
-        # Remove lock file
-        if os.listdir(self.DEPLOY_DIR).__contains__(self.LOCK_FILE_HANDLE):
-            os.remove(self.LOCK_FILE_HANDLE)
-        else:
-            raise SartorisError(message=exit_codes[4])
+    def push(self, args):
+        """
+            * push new deploy tags and the branch to the configured remotes
+        """
+        if not self._push_deploy_refs():
+            raise SartorisError(message=exit_codes[13], exit_code=13)
+        return 0
+
+    def verify(self, args):
+        """
+            * compare the working tree with the tree of the deployed tag
+            * emit any drift as JSON
+        """
+        deploy_info = self._read_json(self.config['deploy_file'])
+        if not deploy_info:
+            exit_code = 50
+            log.error("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            return exit_code
+
+        repo = self._get_repo()
+        commit_sha = self._get_commit_sha_for_tag(deploy_info['tag'])
+        unit_path = self.config['unit_path']
+        modified, missing, added = self._find_drift(
+            repo, self._get_subtree(
+                repo, self._get_object(repo, commit_sha).tree, unit_path),
+            unit_path)
+
+        print json.dumps({'tag': deploy_info['tag'],
+                          'clean': not (modified or missing or added),
+                          'modified': modified,
+                          'missing': missing,
+                          'added': added})
+        if modified or missing or added:
+            exit_code = 51
+            log.warning("{0}::{1}".format(__name__, exit_codes[exit_code]))
+            return exit_code
+        return 0
+
+    def artifact_fetch(self, args):
+        """
+            * copy the cached build output of a subtree of a tag to a path
+            * exit with 60 when the subtree has not been built before
+
+            e.g. in a sync hook: sartoris artifact_fetch $TAG static out/
+        """
+        if len(getattr(args, 'operands', [])) != 3:
+            raise SartorisError(message=exit_codes[3], exit_code=3)
+        tag, path, dest = args.operands
+
+        key = self._get_tree_sha(tag, path)
+        if not self._get_artifact_cache().fetch(key, dest):
+            log.info('{0}::No artifact cached for {1}.'.format(__name__, key))
+            return 60
+        return 0
+
+    def artifact_store(self, args):
+        """
+            * cache the build output of a subtree of a tag
+
+            e.g. in a sync hook: sartoris artifact_store $TAG static out/
+        """
+        if len(getattr(args, 'operands', [])) != 3:
+            raise SartorisError(message=exit_codes[3], exit_code=3)
+        tag, path, src = args.operands
+
+        key = self._get_tree_sha(tag, path)
+        if not self.backend.persistent:
+            log.info('{0}::Dry run, not caching {1}.'.format(__name__, key))
+            return 0
+        try:
+            self._get_artifact_cache().store(key, src)
+        except (IOError, OSError) as e:
+            exit_code = 63
+            log.error("{0}::{1} {2}".format(__name__,
+                                            exit_codes[exit_code], e))
+            return exit_code
+        return 0
+
+    def watch(self, args):
+        """
+            * emit a JSON line for each start, sync, abort and revert
+        """
+        try:
+            for event in self.watch_events():
+                print json.dumps(event)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
         return 0
 
     def show_tag(self, args):
@@ -453,6 +2336,139 @@ class Sartoris(object):
         log.info(self._tag)
         return 0
 
+    def _resolve_commit(self, repo, name):
+        """ Returns the sha of the commit a ref, tag or sha points at """
+        for ref in (name, 'refs/tags/' + name, 'refs/heads/' + name):
+            if ref in repo.refs:
+                name = repo.refs[ref]
+                break
+        try:
+            obj = repo[name]
+            while isinstance(obj, Tag):
+                obj = repo[obj.object[1]]
+        except (KeyError, ValueError):
+            raise SartorisError(message=exit_codes[62], exit_code=62)
+        if not isinstance(obj, Commit):
+            raise SartorisError(message=exit_codes[62], exit_code=62)
+        return obj.id
+
+    def _get_object_sizes(self, repo, shas):
+        """ Returns the uncompressed and packed size of each of ``shas``.
+            Objects never change, so sizes are cached for good. """
+        cache_file = self.config['deploy_root'] + \
+            self.OBJECT_SIZE_CACHE_HANDLE
+        cache = self._read_json(cache_file) or {}
+        missing = [sha for sha in shas if sha not in cache]
+        if missing:
+            object_sizes = ObjectSizes(repo.object_store)
+            for sha in missing:
+                size = object_sizes.get(sha)
+                if size is not None:
+                    cache[sha] = size
+            try:
+                self._write_json(cache_file, cache)
+            except (IOError, OSError):
+                log.warning(__name__ + '::Could not cache object sizes.')
+        return dict((sha, cache.get(sha, (0, 0))) for sha in shas)
+
+    def _plan(self, repo, old_tree, new_tree):
+        """ Sums the sizes of the blobs added or changed from ``old_tree``
+            to ``new_tree`` per top level directory """
+        blobs = {}
+        for change in tree_changes(repo.object_store, old_tree, new_tree):
+            if change.new.sha is not None and \
+                    not S_ISGITLINK(change.new.mode):
+                blobs[change.new.path] = change.new.sha
+        sizes = self._get_object_sizes(repo, set(blobs.values()))
+
+        plan = {'dirs': {}, 'files': 0, 'size': 0, 'packed': 0}
+        for path, sha in blobs.iteritems():
+            top = path.split('/', 1)[0] if '/' in path else '.'
+            size, packed = sizes[sha]
+            for summary in (plan, plan['dirs'].setdefault(
+                    top, {'files': 0, 'size': 0, 'packed': 0})):
+                summary['files'] += 1
+                summary['size'] += size
+                summary['packed'] += packed
+        return plan
+
+    def plan(self, args):
+        """
+            * estimate the transfer size of deploying a commit, HEAD by
+              default, on top of the last sync tag
+            * bytes and files per top level directory
+        """
+        operands = getattr(args, 'operands', [])
+        if len(operands) > 1:
+            raise SartorisError(message=exit_codes[3], exit_code=3)
+        candidate = operands[0] if operands else 'HEAD'
+
+        repo = self._get_repo()
+        unit_path = self.config['unit_path']
+        sync_tags = self._get_deploy_tags('sync')
+        if sync_tags:
+            deployed = sync_tags[-1]
+            old_tree = self._get_subtree(repo, self._get_object(
+                repo, self._get_commit_sha_for_tag(deployed)).tree,
+                unit_path)
+        else:
+            deployed, old_tree = None, None
+        new_tree = self._get_subtree(repo, self._get_object(
+            repo, self._resolve_commit(repo, candidate)).tree, unit_path)
+
+        plan = self._plan(repo, old_tree, new_tree)
+        plan['from'] = deployed
+        plan['to'] = candidate
+        if getattr(args, 'json', False):
+            print json.dumps(plan)
+            return 0
+
+        print 'Plan from {0} to {1}\n'.format(deployed or '(nothing)',
+                                              candidate)
+        for top in sorted(plan['dirs']):
+            summary = plan['dirs'][top]
+            print '{0:<30} {1:>6} files {2:>12} bytes {3:>12} packed'.format(
+                top, summary['files'], summary['size'], summary['packed'])
+        print '\n{0} files, {1} bytes, {2} packed'.format(
+            plan['files'], plan['size'], plan['packed'])
+        return 0
+
+    def stats(self, args):
+        """
+            * show deploy frequency, durations and abort rate, of the last
+              DAYS days if given
+        """
+        operands = getattr(args, 'operands', [])
+        try:
+            days, = [int(day) for day in operands] or [0]
+        except ValueError:
+            raise SartorisError(message=exit_codes[3], exit_code=3)
+        since = int(time()) - days * 86400 if days > 0 else 0
+
+        summary = self._get_deploy_stats().summary(since)
+        if getattr(args, 'json', False):
+            print json.dumps(summary)
+            return 0
+
+        print 'Deploys of {0} {1}\n'.format(
+            self.config['tag_prefix'],
+            'in the last {0} days'.format(days) if since else 'all time')
+        print 'deploys  {0} ({1} per week)'.format(
+            summary['deploys'], '{0:.1f}'.format(summary['per_week'])
+            if summary['per_week'] is not None else '-')
+        print 'aborts   {0} of {1} starts ({2}), {3} abandoned'.format(
+            summary['aborts'], summary['starts'],
+            '{0:.0%}'.format(summary['abort_rate'])
+            if summary['abort_rate'] is not None else '-',
+            summary['abandoned'])
+        print 'reverts  {0}'.format(summary['reverts'])
+        duration = summary['duration']
+        if duration['mean'] is not None:
+            print 'duration mean {0:.0f}s, median {1}s, p90 {2}s, ' \
+                'max {3}s'.format(duration['mean'], duration['median'],
+                                  duration['p90'], duration['max'])
+        return 0
+
     def log_deploys(self, args):
         """
             * show last x deploys
@@ -463,18 +2479,139 @@ class Sartoris(object):
         except NameError:
             raise SartorisError(message=exit_codes[10], exit_code=10)
 
-        # Get tags for project
-        proc = subprocess.Popen("git tag".split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-
         # Pull last 'num_tags' sync tags
-        for tag in proc.communicate()[0].split('\n'):
-            if not num_tags:
-                break
-            if search(r'sync', tag):
+        sync_tags = self._get_deploy_tags('sync')
+        sync_tags = sync_tags[-num_tags:] if num_tags > 0 else []
+
+        # In verbose mode resolve commit metadata for all tags at once
+        if getattr(args, 'verbose', 0):
+            resolved = self._resolve_tags(sync_tags)
+            for tag in sync_tags:
+                info = resolved[tag]
+                log.info('{0} {1} {2} {3} {4}'.format(
+                    tag, info['sha'], info['author'],
+                    datetime.fromtimestamp(info['commit_time']).strftime(
+                        self.DATE_TIME_TAG_FORMAT),
+                    info['message'].split('\n')[0]))
+        else:
+            for tag in sync_tags:
                 log.info(tag)
-                num_tags -= 1
+        return 0
+
+    def _line_stats(self, repo, change):
+        """ Returns the (added, removed) line counts of a tree change """
+        lines = []
+        for entry in (change.old, change.new):
+            if entry.sha is None:
+                lines.append([])
+                continue
+            data = self._get_object(repo, entry.sha).as_raw_string()
+            if '\0' in data or len(data) > self.LINE_STATS_MAX_SIZE:
+                # Binary or huge blob, no meaningful or affordable line stats
+                return 0, 0
+            lines.append(data.splitlines())
+
+        added = removed = 0
+        matcher = difflib.SequenceMatcher(None, lines[0], lines[1])
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op in ('replace', 'delete'):
+                removed += i2 - i1
+            if op in ('replace', 'insert'):
+                added += j2 - j1
+        return added, removed
+
+    def _build_changelog(self, repo, from_sha, to_sha, path=''):
+        """ Walk the commits reachable from ``to_sha`` but not ``from_sha``
+            and summarise each one along with aggregate file stats.  With
+            ``path`` set only the commits and trees below it are looked at.
+        """
+        commits = []
+        files = {}
+        walker = repo.get_walker(include=[to_sha], exclude=[from_sha],
+                                 paths=[path] if path else None)
+        for entry in walker:
+            commit = entry.commit
+            if commit.parents:
+                parent_tree = self._get_subtree(
+                    repo, self._get_object(repo, commit.parents[0]).tree,
+                    path)
+            else:
+                parent_tree = None
+
+            summary = {
+                'sha': commit.id,
+                'author': commit.author,
+                'commit_time': commit.commit_time,
+                'subject': commit.message.split('\n')[0],
+                'files': 0,
+                'added': 0,
+                'removed': 0,
+            }
+            for change in tree_changes(
+                    repo.object_store, parent_tree,
+                    self._get_subtree(repo, commit.tree, path)):
+                added, removed = self._line_stats(repo, change)
+                file_path = posixpath.join(
+                    path, change.new.path or change.old.path)
+                stats = files.setdefault(file_path,
+                                         {'added': 0, 'removed': 0})
+                stats['added'] += added
+                stats['removed'] += removed
+                summary['files'] += 1
+                summary['added'] += added
+                summary['removed'] += removed
+            commits.append(summary)
+
+        return {
+            'commits': commits,
+            'files': files,
+            'added': sum(c['added'] for c in commits),
+            'removed': sum(c['removed'] for c in commits),
+        }
+
+    def changelog(self, args):
+        """
+            * show the commits between two deploy tags, FROM exclusive
+            * aggregate per file line stats
+        """
+        if len(getattr(args, 'operands', [])) != 2:
+            raise SartorisError(message=exit_codes[3], exit_code=3)
+        from_tag, to_tag = args.operands
+
+        resolved = self._resolve_tags([from_tag, to_tag])
+        from_sha = resolved[from_tag]['sha']
+        to_sha = resolved[to_tag]['sha']
+
+        # Walker results are cached on the commit pair the tags point at
+        unit_path = self.config['unit_path']
+        cache_key = '{0}-{1}'.format(from_sha, to_sha)
+        if unit_path:
+            cache_key += '-' + hashlib.sha1(unit_path).hexdigest()
+        cache_file = '{0}{1}/{2}.json'.format(
+            self.config['deploy_root'], self.CHANGELOG_CACHE_DIR, cache_key)
+        changelog = self._read_json(cache_file)
+        if changelog is None:
+            changelog = self._build_changelog(self._get_repo(), from_sha,
+                                              to_sha, unit_path)
+            try:
+                self._write_json(cache_file, changelog)
+            except (IOError, OSError):
+                log.warning(__name__ + '::Could not cache changelog.')
+
+        changelog['from'] = from_tag
+        changelog['to'] = to_tag
+        if args.json:
+            print json.dumps(changelog)
+            return 0
+
+        print 'Changes from {0} to {1}\n'.format(from_tag, to_tag)
+        for commit in changelog['commits']:
+            print '{0} {1} ({2}, {3} files, +{4} -{5})'.format(
+                commit['sha'][:7], commit['subject'], commit['author'],
+                commit['files'], commit['added'], commit['removed'])
+        print '\n{0} commits, {1} files changed, +{2} -{3}'.format(
+            len(changelog['commits']), len(changelog['files']),
+            changelog['added'], changelog['removed'])
         return 0
 
     def diff(self, args):
@@ -483,39 +2620,22 @@ class Sartoris(object):
         """
 
         # Get the last two tags - assumes tagging on deployment only
-        proc = subprocess.Popen("git tag".split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,)
-
-        # Get the last two tags
-        sync_tags = filter(lambda x: search(r'sync', x),
-                           proc.communicate()[0].split('\n'))
-
-        # Check the return code & whether at least two sync tags were
-        # returned
-        if proc.returncode:
-            raise SartorisError(message=exit_codes[6], exit_code=6)
-        elif len(sync_tags) < 2:
+        sync_tags = self._get_deploy_tags('sync')[-2:]
+        if len(sync_tags) < 2:
             raise SartorisError(message=exit_codes[7], exit_code=7)
 
         # Get the associated commit hashes for those tags
-        sha_1 = self._get_commit_sha_for_tag(sync_tags[0])
-        sha_2 = self._get_commit_sha_for_tag(sync_tags[1])
-
-        # Produce the diff
-        # @TODO replace with dulwich
-        proc = subprocess.Popen("git diff {0} {1}".format(sha_2, sha_1).
-                                split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        proc.communicate()
-
-        if not proc.returncode:
-            line = proc.stdout.readline()
-            while line:
-                print line
-                line = proc.stdout.readline()
-        else:
+        resolved = self._resolve_tags(sync_tags)
+        repo = self._get_repo()
+        unit_path = self.config['unit_path']
+        try:
+            old_tree = self._get_subtree(repo, self._get_object(
+                repo, resolved[sync_tags[0]]['sha']).tree, unit_path)
+            new_tree = self._get_subtree(repo, self._get_object(
+                repo, resolved[sync_tags[1]]['sha']).tree, unit_path)
+            write_tree_diff(sys.stdout, repo.object_store, old_tree,
+                            new_tree)
+        except KeyError:
             raise SartorisError(message=exit_codes[6], exit_code=6)
         return 0
 
@@ -553,13 +2673,25 @@ def main(argv, out=None, err=None):
         print args.help
         return 3
 
-    if hasattr(Sartoris(), args.method) and callable(getattr(Sartoris(),
-                                                     args.method)):
+    sartoris_obj = Sartoris(env=args.env, unit=args.unit,
+                            dry_run=args.dry_run)
+    if hasattr(sartoris_obj, args.method) and callable(getattr(sartoris_obj,
+                                                       args.method)):
+        if args.profile:
+            profiler = Profiler()
+            profiler.start()
         try:
-            getattr(Sartoris(), args.method)(args)
+            return getattr(sartoris_obj, args.method)(args)
         except SartorisError as e:
             log.error(e.message)
             return e.exit_code
+        finally:
+            if args.profile:
+                profiler.stop()
+                log.info('{0}::Profile written to {1}.*'.format(
+                    __name__, profiler.write(
+                        os.path.join(sartoris_obj.config['top_dir'],
+                                     Sartoris.PROFILE_DIR), args.method)))
     else:
         log.error(__name__ + '::No function called %(method)s.' % {
             'method': args.method})
@@ -9,11 +9,24 @@
 """
 
 import unittest
-from sartoris.sartoris import Sartoris, SartorisError, exit_codes
+import subprocess
+import threading
+from time import sleep
+from timeit import default_timer
+from sartoris.sartoris import Sartoris, SartorisError, ArtifactCache, \
+    DeployStats, DiskBackend, MemoryBackend, ObjectSizes, Profiler, \
+    SyncScheduler, TokenBucket, exit_codes
 from sartoris import config
+from dulwich.index import commit_tree
+from dulwich.file import FileLocked
+from dulwich.object_store import tree_lookup_path
+from dulwich.objects import Blob
 from dulwich.repo import Repo
-from os import mkdir, chdir
+from os import chmod, listdir, mkdir, chdir, remove, stat
+from os.path import exists, join
 from shutil import rmtree
+from stat import S_IMODE
+from tempfile import mkdtemp
 
 
 def tester_deco(test_method):
@@ -45,6 +58,49 @@ def teardown_test_repo():
     rmtree(config.TEST_REPO)
 
 
+def commit_files(repo, files):
+    """
+    Commit a dict of paths to contents to ``repo`` without a working tree
+    """
+    blobs = []
+    for path, data in files.iteritems():
+        blob = Blob.from_string(data)
+        repo.object_store.add_object(blob)
+        blobs.append((path, blob.id, 0100644))
+    return repo.do_commit('commit', committer='author <author@domain.com>',
+                          tree=commit_tree(repo.object_store, blobs),
+                          ref='refs/heads/master')
+
+
+class ThrottledTarget(object):
+    """
+    Stand-in for sync targets on a shared storage backend, transfers share
+    ``rate`` bytes per second and slow down fourfold once more than
+    ``knee`` run at once
+    """
+    def __init__(self, size, rate, knee):
+        self.size = size
+        self.rate = rate
+        self.knee = knee
+        self.active = 0
+        self.max_active = 0
+        self.bandwidths = []
+        self.lock = threading.Lock()
+
+    def __call__(self, target, bandwidth):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.bandwidths.append(bandwidth)
+            rate = float(self.rate) / self.active
+            if self.active > self.knee:
+                rate /= 4
+        sleep(self.size / rate)
+        with self.lock:
+            self.active -= 1
+        return target != 'broken'
+
+
 class TestNullHandler(unittest.TestCase):
     def test_emit(self):
         # null_handler = NullHandler()
@@ -58,6 +114,188 @@ class TestParseargs(unittest.TestCase):
         assert False  # TODO: implement your test here
 
 
+class TestProfiler(unittest.TestCase):
+    def test_profile_subprocess(self):
+        profiler = Profiler()
+        profiler.start()
+        subprocess.Popen(['true']).communicate()
+        profiler.stop()
+
+        assert any(key.split(';')[-1].startswith('subprocess.')
+                   for key in profiler.stacks)
+        assert '[subprocess]' in profiler.summary()
+
+        out_dir = mkdtemp()
+        try:
+            path = profiler.write(out_dir, 'test')
+            with open(path + '.collapsed') as f:
+                for line in f:
+                    stack, micros = line.rsplit(' ', 1)
+                    assert int(micros) >= 0
+        finally:
+            rmtree(out_dir)
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def _build(self, name, size):
+        path = join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        return path
+
+    def test_store_fetch(self):
+        cache = ArtifactCache(join(self.tmp_dir, 'cache'), 100)
+        cache.store('abc', self._build('built', 10))
+        dest = join(self.tmp_dir, 'dest')
+        assert cache.fetch('abc', dest)
+        with open(dest) as f:
+            assert f.read() == 'x' * 10
+        assert not cache.fetch('def', dest)
+
+    def test_evict_lru(self):
+        cache = ArtifactCache(join(self.tmp_dir, 'cache'), 100)
+        cache.store('old', self._build('old', 60))
+        cache.store('new', self._build('new', 60))
+        dest = join(self.tmp_dir, 'dest')
+        assert not cache.fetch('old', dest)
+        assert cache.fetch('new', dest)
+
+    def test_concurrent_store(self):
+        """
+        concurrent_store - test that parallel writers keep every entry
+        indexed
+        """
+        directory = join(self.tmp_dir, 'cache')
+        src = self._build('built', 10)
+
+        def store(writer):
+            cache = ArtifactCache(directory, 10 ** 6)
+            for i in range(20):
+                cache.store('{0}-{1}'.format(writer, i), src)
+        threads = [threading.Thread(target=store, args=(writer,))
+                   for writer in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        index = ArtifactCache(directory, 10 ** 6)._read_index()
+        assert len(index) == 160
+        assert sorted(index) == sorted(name for name in listdir(directory)
+                                       if not name.startswith('.') and
+                                       name != 'index')
+
+
+class TestSyncScheduler(unittest.TestCase):
+    """ Test cases scheduling transfers to throttled stand-in targets """
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10000)
+        assert bucket.take(10000) == 0.0
+        assert 0.05 < bucket.take(1000) < 0.2
+        assert TokenBucket(None).take(10 ** 9) == 0.0
+
+    def test_adapt(self):
+        """
+        adapt - test that concurrency grows while throughput holds and
+        halves when it drops or a transfer fails
+        """
+        scheduler = SyncScheduler(None, concurrency=8,
+                                  group_concurrency={'db': 3})
+        for throughput in (100, 150, 140):
+            scheduler._adapt('', throughput, True)
+        assert scheduler.limits[''] == 4
+        scheduler._adapt('', 50, True)
+        assert scheduler.limits[''] == 2
+        scheduler._adapt('', 150, False)
+        assert scheduler.limits[''] == 1
+        for throughput in (100, 100, 100):
+            scheduler._adapt('db', throughput, True)
+        assert scheduler.limits['db'] == 3
+
+    def test_run_all(self):
+        """
+        run_all - test that every target is transferred within the
+        concurrency budgets and failures are reported
+        """
+        storage = ThrottledTarget(1000, 200000, 2)
+        targets = ['t{0}'.format(i) for i in range(12)] + ['broken']
+        scheduler = SyncScheduler(
+            storage, groups=dict((t, 'a') for t in targets[:6]),
+            concurrency=3, group_concurrency={'a': 2},
+            group_bandwidth={'a': 1000000})
+        results = scheduler.run_all(targets, 1000)
+        assert sorted(results) == sorted(targets)
+        assert [t for t in results if not results[t]] == ['broken']
+        assert 1 < storage.max_active <= 3
+        assert set(scheduler.limits) == set(['', 'a'])
+        assert None in storage.bandwidths
+        assert max(storage.bandwidths) <= 1000000
+
+    def test_bandwidth(self):
+        """
+        bandwidth - test that transfers are paced by the global budget
+        """
+        start = default_timer()
+        SyncScheduler(ThrottledTarget(1, 10 ** 6, 8), concurrency=4,
+                      bandwidth=20000).run_all(range(6), 5000)
+        assert default_timer() - start > 0.45
+
+
+class TestDeployStats(unittest.TestCase):
+    """ Test cases for the columnar deploy summary """
+
+    def setUp(self):
+        self.stats = DeployStats()
+        self.stats.start('s1', 1000)
+        self.stats.sync(1030)
+        self.stats.start('s2', 2000)
+        self.stats.start('s3', 3000)
+        self.stats.sync(3090)
+        self.stats.start('s4', 4000)
+        self.stats.abort('s4', 4000)
+        self.stats.revert(4100)
+
+    def test_summary(self):
+        summary = self.stats.summary(until=1030 + 604800)
+        assert summary['deploys'] == 2
+        assert summary['per_week'] == 2.0
+        assert (summary['starts'], summary['aborts'],
+                summary['abandoned']) == (4, 1, 1)
+        assert summary['abort_rate'] == 0.25
+        assert summary['reverts'] == 1
+        assert summary['duration'] == {'mean': 60.0, 'median': 90,
+                                       'p90': 90, 'max': 90}
+
+    def test_abort_abandoned(self):
+        """
+        abort_abandoned - test that an abort read after the next start
+        turns the abandoned start into an aborted one
+        """
+        self.stats.abort('s2', 2000)
+        summary = self.stats.summary()
+        assert (summary['aborts'], summary['abandoned']) == (2, 0)
+
+    def test_window(self):
+        summary = self.stats.summary(since=2500, until=5000)
+        assert (summary['deploys'], summary['starts'],
+                summary['aborts']) == (1, 2, 1)
+        assert summary['duration']['max'] == 90
+
+    def test_dumps(self):
+        stats = DeployStats.loads(self.stats.dumps())
+        assert stats.columns == self.stats.columns
+        assert stats.state == self.stats.state
+        with self.assertRaises(ValueError):
+            DeployStats.loads('corrupt')
+
+
 class TestSartorisInit(unittest.TestCase):
     """ Test cases for Sartoris initialization and config """
     def test_conf_hook_dir(self):
@@ -80,6 +318,13 @@ class TestSartorisInit(unittest.TestCase):
         # sartoris = Sartoris(*args, **kwargs)
         assert False  # TODO: implement your test here
 
+    def test_conf_env(self):
+        s = Sartoris(env='staging')
+        assert s is Sartoris(env='staging')
+        assert s is not Sartoris()
+        assert s.config['tag_prefix'] == s.config['repo_name'] + '-staging'
+        assert s.config['deploy_dir'] != Sartoris().config['deploy_dir']
+
 
 class TestSartorisFunctionality(unittest.TestCase):
 
@@ -206,6 +451,570 @@ class TestSartorisFunctionality(unittest.TestCase):
             return
         assert False
 
+    @tester_deco
+    def test_sync_state_checkpoint(self):
+        """
+        sync_state_checkpoint - test that synced targets are checkpointed
+        per tag and that a different tag does not resume from them
+        """
+        sartoris_obj = Sartoris()
+        mkdir(sartoris_obj.DEPLOY_DIR)
+        sartoris_obj._write_sync_state('repo-sync-1', set(['host1']))
+        assert sartoris_obj._read_sync_state('repo-sync-1') == set(['host1'])
+        assert sartoris_obj._read_sync_state('repo-sync-2') == set()
+        sartoris_obj._clear_sync_state()
+        assert sartoris_obj._read_sync_state('repo-sync-1') == set()
+
+    @tester_deco
+    def test_resolve_tags(self):
+        """
+        resolve_tags - test that tags are resolved to their commit metadata
+        """
+        repo = Repo(config.TEST_REPO)
+        commit_sha = repo.do_commit('deploy commit',
+                                    committer='author <author@domain.com>')
+        repo.refs['refs/tags/repo-sync-1'] = commit_sha
+
+        resolved = Sartoris()._resolve_tags(['repo-sync-1'])
+        assert resolved['repo-sync-1']['sha'] == commit_sha
+        assert resolved['repo-sync-1']['message'] == 'deploy commit'
+
+        try:
+            Sartoris()._resolve_tags(['repo-sync-2'])
+        except SartorisError as e:
+            assert e.exit_code == 7
+            return
+        assert False
+
+    @tester_deco
+    def test_build_changelog(self):
+        """
+        build_changelog - test that commits reachable from the first tag are
+        excluded and line stats are aggregated
+        """
+        repo = Repo(config.TEST_REPO)
+        committer = 'author <author@domain.com>'
+        with open('README', 'w') as f:
+            f.write('one\n')
+        repo.stage(['README'])
+        from_sha = repo.do_commit('first', committer=committer)
+        with open('README', 'w') as f:
+            f.write('one\ntwo\n')
+        repo.stage(['README'])
+        to_sha = repo.do_commit('second', committer=committer)
+
+        changelog = Sartoris()._build_changelog(repo, from_sha, to_sha)
+        assert [c['sha'] for c in changelog['commits']] == [to_sha]
+        assert changelog['files'] == {'README': {'added': 1, 'removed': 0}}
+
+        sartoris_obj = Sartoris()
+        sartoris_obj.LINE_STATS_MAX_SIZE = 4
+        try:
+            changelog = sartoris_obj._build_changelog(repo, from_sha, to_sha)
+        finally:
+            del sartoris_obj.LINE_STATS_MAX_SIZE
+        assert changelog['files'] == {'README': {'added': 0, 'removed': 0}}
+
+    @tester_deco
+    def test_env_locks(self):
+        """
+        env_locks - test that deployments to different environments can be
+        started independently
+        """
+        try:
+            Sartoris(env='staging').start(None)
+            Sartoris(env='production').start(None)
+        except SartorisError:
+            assert False
+
+    @tester_deco
+    def test_push_remote(self):
+        """
+        push_remote - test that deploy tags and the branch are pushed to a
+        bare repo remote
+        """
+        remote_dir = config.TEST_REPO + '/remote.git'
+        mkdir(remote_dir)
+        remote = Repo.init_bare(remote_dir)
+
+        sartoris_obj = Sartoris()
+        sartoris_obj.start(None)
+        sartoris_obj._push_remote(remote_dir)
+
+        local_refs = Repo(config.TEST_REPO).get_refs()
+        for ref in local_refs:
+            if ref.startswith('refs/tags/') or ref == 'refs/heads/master':
+                assert remote.refs[ref] == local_refs[ref]
+
+    @tester_deco
+    def test_unreachable_remote(self):
+        """
+        unreachable_remote - test that a failing mirror does not fail the
+        deploy, only an explicit push
+        """
+        sartoris_obj = Sartoris(backend=DiskBackend(
+            config.TEST_REPO, config={'hook-dir': '/nonexistent',
+                                      'tag-prefix': 'repo',
+                                      'remotes': '/nonexistent/remote.git'}))
+        assert sartoris_obj.start(None) == 0
+        assert sartoris_obj.sync(None) == 0
+        assert not sartoris_obj._check_lock()
+        sartoris_obj.show_tag(None)
+        assert sartoris_obj._read_json(
+            sartoris_obj.config['deploy_file'])['tag'] == sartoris_obj._tag
+        with self.assertRaises(SartorisError) as cm:
+            sartoris_obj.push(None)
+        assert cm.exception.exit_code == 13
+
+    def test_disk_backend_write(self):
+        """
+        disk_backend_write - test that a write replaces the file in place
+        with its usual mode and leaves no temp file behind
+        """
+        directory = mkdtemp()
+        try:
+            backend = DiskBackend(directory)
+            path = join(directory, 'state', '.deploy')
+            backend.write(path, 'one')
+            backend.write(path, 'two')
+            assert backend.read(path) == 'two'
+            assert listdir(join(directory, 'state')) == ['.deploy']
+            assert S_IMODE(stat(path).st_mode) == 0666 & ~backend.umask
+        finally:
+            rmtree(directory)
+
+    @tester_deco
+    def test_abort_restores_tree(self):
+        """
+        abort_restores_tree - test that ``abort`` restores the files of the
+        start tag and commits the revert
+        """
+        repo = Repo(config.TEST_REPO)
+        committer = 'author <author@domain.com>'
+        with open('README', 'w') as f:
+            f.write('start\n')
+        repo.stage(['README'])
+        repo.do_commit('initial', committer=committer)
+
+        sartoris_obj = Sartoris()
+        sartoris_obj.start(None)
+        with open('README', 'w') as f:
+            f.write('changed\n')
+        with open('NEW', 'w') as f:
+            f.write('new\n')
+        repo.stage(['README', 'NEW'])
+        repo.do_commit('change', committer=committer)
+        sartoris_obj.abort(None)
+
+        with open('README') as f:
+            assert f.read() == 'start\n'
+        assert not exists('NEW')
+        assert repo['HEAD'].message.startswith('Revert to ')
+        assert not sartoris_obj._check_lock()
+
+    @tester_deco
+    def test_find_drift(self):
+        """
+        find_drift - test that modified, missing and added files are
+        reported against a tree and that the stat cache is written
+        """
+        repo = Repo(config.TEST_REPO)
+        with open('README', 'w') as f:
+            f.write('deployed\n')
+        with open('CONFIG', 'w') as f:
+            f.write('deployed\n')
+        repo.stage(['README', 'CONFIG'])
+        commit_sha = repo.do_commit('deploy',
+                                    committer='author <author@domain.com>')
+
+        sartoris_obj = Sartoris()
+        mkdir(sartoris_obj.config['deploy_dir'])
+        tree_id = repo[commit_sha].tree
+        with open('.deploy', 'w') as f:
+            f.write('{}')
+        assert sartoris_obj._find_drift(repo, tree_id) == ([], [], [])
+
+        with open('README', 'w') as f:
+            f.write('drifted\n')
+        remove('CONFIG')
+        mkdir('static')
+        with open(join('static', 'app.js'), 'w') as f:
+            f.write('added\n')
+        assert sartoris_obj._find_drift(repo, tree_id) == \
+            (['README'], ['CONFIG'], ['static/app.js'])
+        assert exists(sartoris_obj.config['deploy_dir'] +
+                      sartoris_obj.STAT_CACHE_HANDLE)
+
+    @tester_deco
+    def test_get_tree_sha(self):
+        """
+        get_tree_sha - test that a subtree keeps its sha across tags when
+        only other paths change
+        """
+        repo = Repo(config.TEST_REPO)
+        committer = 'author <author@domain.com>'
+        mkdir('static')
+        with open('static/app.js', 'w') as f:
+            f.write('app\n')
+        with open('README', 'w') as f:
+            f.write('one\n')
+        repo.stage(['static/app.js', 'README'])
+        repo.refs['refs/tags/repo-sync-1'] = repo.do_commit(
+            'first', committer=committer)
+        with open('README', 'w') as f:
+            f.write('two\n')
+        repo.stage(['README'])
+        repo.refs['refs/tags/repo-sync-2'] = repo.do_commit(
+            'second', committer=committer)
+
+        sartoris_obj = Sartoris()
+        assert sartoris_obj._get_tree_sha('repo-sync-1', 'static') == \
+            sartoris_obj._get_tree_sha('repo-sync-2', 'static/')
+        assert sartoris_obj._get_tree_sha('repo-sync-1') != \
+            sartoris_obj._get_tree_sha('repo-sync-2')
+
+    @tester_deco
+    def test_object_sizes(self):
+        """
+        object_sizes - test that sizes read from loose and packed object
+        headers match the object contents
+        """
+        repo = Repo(config.TEST_REPO)
+        with open('README', 'w') as f:
+            f.write('readme\n' * 1000)
+        repo.stage(['README'])
+        repo.do_commit('initial', committer='author <author@domain.com>')
+        blob = repo[repo[repo['HEAD'].tree]['README'][1]]
+
+        size, packed = ObjectSizes(repo.object_store).get(blob.id)
+        assert size == blob.raw_length() == 7000
+        assert 0 < packed < size
+        subprocess.check_call(['git', 'gc', '-q'])
+        assert ObjectSizes(Repo(config.TEST_REPO).object_store).get(
+            blob.id)[0] == 7000
+        assert ObjectSizes(repo.object_store).get('0' * 40) is None
+
+    @tester_deco
+    def test_resync_failed_targets(self):
+        """
+        resync_failed_targets - test that resync only reruns the targets
+        the sync hook failed for
+        """
+        hook_dir = mkdtemp()
+        try:
+            mkdir(join(hook_dir, 'sync'))
+            hook = join(hook_dir, 'sync', 'repo.sync')
+            with open(hook, 'w') as f:
+                f.write('#!/bin/sh\n'
+                        'for arg; do case "$arg" in --target=*) '
+                        'target=${arg#--target=};; esac; done\n'
+                        'echo "$target" >> ' + join(hook_dir, 'calls') +
+                        '\ngrep -qx "$target" ' + join(hook_dir, 'fail') +
+                        ' && exit 1\nexit 0\n')
+            chmod(hook, 0755)
+            with open(join(hook_dir, 'fail'), 'w') as f:
+                f.write('web2\n')
+
+            sartoris_obj = Sartoris(backend=DiskBackend(
+                config.TEST_REPO, config={'hook-dir': hook_dir,
+                                          'tag-prefix': 'repo',
+                                          'targets': 'web1 web2 web3'}))
+            sartoris_obj.start(None)
+            assert sartoris_obj.sync(None) == 40
+            remove(join(hook_dir, 'fail'))
+            remove(join(hook_dir, 'calls'))
+            assert sartoris_obj.resync(None) == 0
+            with open(join(hook_dir, 'calls')) as f:
+                assert f.read() == 'web2\n'
+            assert not sartoris_obj._check_lock()
+        finally:
+            rmtree(hook_dir)
+
+    @tester_deco
+    def test_deploy_dir_from_subdir(self):
+        """
+        deploy_dir_from_subdir - test that a subdirectory of the checkout
+        shares the lock of the top dir
+        """
+        sartoris_obj = Sartoris()
+        sartoris_obj._create_lock()
+        mkdir('sub')
+        chdir('sub')
+        try:
+            assert Sartoris()._check_lock()
+            assert not exists('.git')
+        finally:
+            chdir(config.TEST_REPO)
+
+
+class TestMemoryBackend(unittest.TestCase):
+    """ Test cases running the deploy state machine in memory """
+
+    def setUp(self):
+        self.backend = MemoryBackend(config={'hook-dir': '/nonexistent',
+                                             'tag-prefix': 'repo'})
+        self.sartoris_obj = Sartoris(backend=self.backend)
+
+    def test_not_singleton(self):
+        assert self.sartoris_obj is not Sartoris(backend=self.backend)
+
+    def test_start_sync(self):
+        """
+        start_sync - test that a deploy runs in memory and leaves a sync tag
+        and deploy file behind without a lock
+        """
+        assert self.sartoris_obj.start(None) == 0
+        assert self.sartoris_obj._check_lock()
+        assert self.sartoris_obj.sync(None) == 0
+        assert not self.sartoris_obj._check_lock()
+
+        self.sartoris_obj.show_tag(None)
+        assert self.sartoris_obj._tag.startswith('repo-sync-')
+        deploy_info = self.sartoris_obj._read_json(
+            self.sartoris_obj.config['deploy_file'])
+        assert deploy_info['tag'] == self.sartoris_obj._tag
+
+    def test_abort_without_deploy(self):
+        """
+        abort_without_deploy - test that abort leaves the branch alone when
+        no deploy is in progress
+        """
+        self.sartoris_obj.start(None)
+        self.sartoris_obj.sync(None)
+        head = self.backend.repo.head()
+        assert self.sartoris_obj.abort(None) == 30
+        assert self.backend.repo.head() == head
+
+    def test_failed_checks_release_lock(self):
+        """
+        failed_checks_release_lock - test that revert and resync refusing to
+        run leave no lock behind
+        """
+        with self.assertRaises(SartorisError) as cm:
+            self.sartoris_obj.revert(None)
+        assert cm.exception.exit_code == 8
+        assert self.sartoris_obj.resync(None) == 50
+        assert not self.sartoris_obj._check_lock()
+        assert self.sartoris_obj.start(None) == 0
+
+    def test_start_tag_failure(self):
+        """
+        start_tag_failure - test that a failed start tag releases the lock
+        """
+        def fail(tag, author):
+            raise IOError('ref locked')
+        self.sartoris_obj._dulwich_tag = fail
+        with self.assertRaises(SartorisError) as cm:
+            self.sartoris_obj.start(None)
+        assert cm.exception.exit_code == 12
+        assert not self.sartoris_obj._check_lock()
+
+    def test_commit_on_branch(self):
+        """
+        commit_on_branch - test that a commit is rebuilt on a branch head
+        moved by another deploy rather than replacing it
+        """
+        repo = self.backend.repo
+        commit_files(repo, {'README': 'r'})
+        s = self.sartoris_obj
+        moved = []
+
+        def build(parent_id):
+            if not moved:
+                moved.append(s._commit_tree(repo, repo[parent_id].tree,
+                                            'other <o@o>', 'other env'))
+            commit = repo[parent_id].copy()
+            commit.parents = [parent_id]
+            commit.message = 'this env'
+            return commit
+        commit = s._commit_on_branch(repo, build)
+        assert commit.parents == moved
+        assert repo.refs['refs/heads/master'] == commit.id
+
+    def test_abort(self):
+        """
+        abort - test that abort commits the start tree and removes the lock
+        """
+        self.sartoris_obj.start(None)
+        assert self.sartoris_obj.abort(None) == 0
+        assert not self.sartoris_obj._check_lock()
+        assert self.backend.repo['HEAD'].message.startswith('Revert to ')
+
+    def test_abort_branch_locked(self):
+        """
+        abort_branch_locked - test that abort fails cleanly and keeps the
+        deploy open when the branch stays locked
+        """
+        def locked(repo, build):
+            raise FileLocked('refs/heads/master', 'refs/heads/master.lock')
+        self.sartoris_obj.start(None)
+        self.sartoris_obj._commit_on_branch = locked
+        with self.assertRaises(SartorisError) as cm:
+            self.sartoris_obj.abort(None)
+        assert cm.exception.exit_code == 5
+        assert self.sartoris_obj._check_lock()
+
+    @tester_deco
+    def test_overlay(self):
+        """
+        overlay - test that a dry run deploy leaves the repo on disk as is
+        """
+        repo = Repo(config.TEST_REPO)
+        head = repo.do_commit('initial',
+                              committer='author <author@domain.com>')
+        sartoris_obj = Sartoris(dry_run=True)
+        sartoris_obj.start(None)
+        sartoris_obj.sync(None)
+
+        assert sartoris_obj._get_repo()['HEAD'].id != head
+        assert Repo(config.TEST_REPO).head() == head
+        assert not Repo(config.TEST_REPO).refs.keys(base='refs/tags')
+        assert not exists(sartoris_obj.config['deploy_file'])
+
+    def test_snapshot_events(self):
+        """
+        snapshot_events - test that deploy events are derived from changes
+        in tags, lock and deploy file
+        """
+        s = self.sartoris_obj
+        empty = s._deploy_snapshot()
+        s.start(None)
+        started = s._deploy_snapshot()
+        assert [e['event'] for e in s._snapshot_events(empty, started)] == \
+            ['start']
+        s.abort(None)
+        aborted = s._deploy_snapshot()
+        assert [e['event'] for e in s._snapshot_events(started, aborted)] == \
+            ['abort']
+
+        s.start(None)
+        started = s._deploy_snapshot()
+        s.sync(None)
+        synced = s._deploy_snapshot()
+        assert [e['event'] for e in s._snapshot_events(started, synced)] == \
+            ['sync']
+        s.revert(None)
+        assert [e['event'] for e in
+                s._snapshot_events(synced, s._deploy_snapshot())] == \
+            ['revert']
+
+    def test_snapshot_events_single_abort(self):
+        """
+        snapshot_events_single_abort - test that a revert after an abort
+        does not emit a second abort for the same start
+        """
+        s = self.sartoris_obj
+        aborted = set()
+        commit_sha = commit_files(self.backend.repo, {'README': 'r'})
+        self.backend.repo.refs['refs/tags/repo-sync-20260101-100000'] = \
+            commit_sha
+        self.backend.repo.refs['refs/tags/repo-start-20260102-100000'] = \
+            commit_sha
+        s._create_lock()
+        locked = s._deploy_snapshot()
+        s._remove_lock()
+        released = s._deploy_snapshot()
+        assert [e['event'] for e in
+                s._snapshot_events(locked, released, aborted)] == ['abort']
+        assert s._snapshot_events(locked, released, aborted) == []
+
+    def test_watch_events_timeout(self):
+        assert list(self.sartoris_obj.watch_events(timeout=0)) == []
+
+    def test_unit(self):
+        """
+        unit - test that a unit is namespaced, that its manifest lists the
+        unit's changes and that abort only resets the unit's subtree
+        """
+        repo = self.backend.repo
+        self.backend.config['units'] = 'api:services/api/'
+        s = Sartoris(backend=self.backend, unit='api')
+        assert s.config['tag_prefix'] == 'repo.api'
+        assert s.config['deploy_dir'].endswith('/unit/api/')
+        assert s.config['deploy_file'].endswith('/services/api/.deploy')
+
+        commit_files(repo, {'services/api/app': 'one', 'lib/util': 'one'})
+        s.start(None)
+        s.sync(None)
+        assert s._read_json(s.config['deploy_file'])['changes'] is None
+        commit_files(repo, {'services/api/app': 'two', 'lib/util': 'two'})
+        s.start(None)
+        s.sync(None)
+        deploy_info = s._read_json(s.config['deploy_file'])
+        assert deploy_info['path'] == 'services/api'
+        assert deploy_info['changes'] == ['app']
+
+        s.start(None)
+        commit_files(repo, {'services/api/app': 'three', 'lib/util': 'three'})
+        s.abort(None)
+        tree_id = repo['HEAD'].tree
+        assert repo[tree_lookup_path(repo.__getitem__, tree_id,
+                                     'services/api/app')[1]].data == 'two'
+        assert repo[tree_lookup_path(repo.__getitem__, tree_id,
+                                     'lib/util')[1]].data == 'three'
+
+    def test_unknown_unit(self):
+        with self.assertRaises(SystemExit) as cm:
+            Sartoris(backend=self.backend, unit='api')
+        assert cm.exception.code == 42
+
+    def test_invalid_config(self):
+        """
+        invalid_config - test that malformed deploy config values exit with
+        a config error rather than a traceback
+        """
+        for item, value in (('concurrency', '0'), ('concurrency', 'four'),
+                            ('bandwidth', '1M'), ('groups', 'web1'),
+                            ('group-concurrency', 'rack1:0'),
+                            ('artifact-cache-size', 'big'), ('units', 'api')):
+            self.backend.config[item] = value
+            with self.assertRaises(SystemExit) as cm:
+                Sartoris(backend=self.backend)
+            assert cm.exception.code == 43
+            del self.backend.config[item]
+
+    def test_plan(self):
+        """
+        plan - test that only blobs changed since the last sync tag are
+        counted, per top level directory
+        """
+        repo = self.backend.repo
+        commit_files(repo, {'lib/a': 'one', 'lib/b': 'one', 'README': 'r'})
+        self.sartoris_obj.start(None)
+        self.sartoris_obj.sync(None)
+        commit_files(repo, {'lib/a': 'three', 'lib/b': 'one', 'README': 'r',
+                            'doc/c': 'seven77'})
+        plan = self.sartoris_obj._plan(
+            repo, repo[self.sartoris_obj._get_commit_sha_for_tag(
+                self.sartoris_obj._get_deploy_tags('sync')[-1])].tree,
+            repo['HEAD'].tree)
+        assert plan['files'] == 2
+        assert plan['dirs'] == {
+            'lib': {'files': 1, 'size': 5, 'packed': 5},
+            'doc': {'files': 1, 'size': 7, 'packed': 7}}
+
+    def test_deploy_stats(self):
+        """
+        deploy_stats - test that the summary follows new tags and journal
+        entries without counting history twice
+        """
+        s = self.sartoris_obj
+        commit_sha = commit_files(self.backend.repo, {'README': 'r'})
+        for tag in ('repo-start-20260101-100000', 'repo-sync-20260101-100100',
+                    'repo-start-20260102-100000'):
+            self.backend.repo.refs['refs/tags/' + tag] = commit_sha
+        stats = s._get_deploy_stats()
+        assert len(stats.columns['durations']) == 1
+        assert stats.state['open_tag'] == 'repo-start-20260102-100000'
+
+        s._journal('abort', 'repo-start-20260102-100000')
+        s._journal('revert', 'repo-sync-20260101-100100')
+        s._get_deploy_stats()
+        summary = s._get_deploy_stats().summary()
+        assert (summary['starts'], summary['aborts'], summary['reverts']) \
+            == (2, 1, 1)
+        assert summary['duration']['max'] == 60
+
 
 class TestMain(unittest.TestCase):
     def test_main(self):